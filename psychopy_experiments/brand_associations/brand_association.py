@@ -8,11 +8,11 @@ Per-trial CSV with timing, keys, and RTs.
 USE_LSL = False  # Set to False to disable LSL markers
 
 if USE_LSL:
-    from pylsl import StreamInfo, StreamOutlet
-from psychopy import visual, core, event, logging
+    from pylsl import StreamInfo, StreamOutlet, local_clock
+from psychopy import visual, core, logging
 from psychopy.hardware import keyboard
-import random, os, csv, math
-from datetime import datetime
+import random, os, csv, math, gc, queue, threading
+from datetime import datetime, timedelta
 from PIL import Image
 from brands_wordlist import WORDLIST
 
@@ -23,6 +23,8 @@ TARGET_TIME = 0.160  # seconds target word on-screen (visual persistence)
 ISI_INTERVAL = (0.540, 0.540)  # seconds (min, max) between PRIME off and TARGET on
 RESP_WINDOW = 1.500  # seconds accepted AFTER cooldown
 ITI_SECONDS = 0.500  # seconds after response/timeout to the next trial (set to 0 to disable)
+FALLBACK_REFRESH_HZ = 60.0  # Used if the refresh rate cannot be measured
+SEED = None  # Seed for trial order and ISIs (None = draw one at startup); written to the CSV
 
 ## Trials & block structure
 # Number of trials, by default use ALL combinations (len(WORDLIST) * len(BRAND_PATHS))
@@ -31,6 +33,9 @@ N_TRIALS = None
 # If TRIALS_PER_BLOCK is None or 0 → single block (no rest screens)
 TRIALS_PER_BLOCK = 80
 
+## Logging
+LOG_FLUSH_EVERY = 20  # trials between CSV flushes (the file is always flushed on close)
+
 ## Display settings
 FULLSCR = False
 WIN_SIZE = [1000, 700]
@@ -60,6 +65,8 @@ BRAND_PATHS = [
 
 ## Prepare wordlist
 REPEATS_PER_WORD = 4  # How many times to repeat each word during the experiment
+# Flat, de-duplicated target words across all categories (first occurrence wins), built once at import
+TARGET_WORDS = tuple(dict.fromkeys(word for category in WORDLIST.values() for word in category))
 
 ## LSL streaming
 if USE_LSL:
@@ -68,14 +75,36 @@ if USE_LSL:
                       source_id='logo_word_n400')
     outlet = StreamOutlet(info)
 
+    # Markers are pushed from a background thread so LSL's push latency stays off the
+    # flip path; each queued marker carries the LSL time it was stamped with
+    marker_q = queue.SimpleQueue()
+
+    def _push_markers():
+        while True:
+            value, ts = marker_q.get()
+            outlet.push_sample([value], ts)
+
+    threading.Thread(target=_push_markers, name="lsl-markers", daemon=True).start()
+
 ## Utilities
 logging.console.setLevel(logging.INFO)
 
 
+def _stamp_marker(value):
+    marker_q.put_nowait((value, local_clock()))
+
+
 def send_marker(win, value):
-    """Send a marker value exactly on next flip."""
+    """Send a marker value exactly on next flip (stamped on the flip, pushed by the marker thread)."""
+    if USE_LSL:
+        win.callOnFlip(_stamp_marker, int(value))
+
+
+def send_marker_for_key(kb, key, value):
+    """Send a marker stamped at a key press that is only read after the fact
+    (the key's age on kb.clock is subtracted from the current LSL time)."""
     if USE_LSL:
-        win.callOnFlip(outlet.push_sample, [int(value)])
+        marker_q.put_nowait((int(value), local_clock() - (kb.clock.getTime() - key.rt)))
 
 
 def resolve_brand_paths(paths):
@@ -106,11 +135,33 @@ def fitted_size_for_image(img_path, max_size):
     return new_w, new_h
 
 
+def frames_for(duration, refresh_hz):
+    """Convert a duration in seconds to a whole number of frames at 'refresh_hz'."""
+    return int(round(duration * refresh_hz))
+
+
 def main():
     # Set up window
     win = visual.Window(size=WIN_SIZE, units='pix', color=BG_COLOR, fullscr=FULLSCR)
-    kb = keyboard.Keyboard()
+    kb = keyboard.Keyboard(backend='ptb')
     logging.info(f"Experiment window initialized: {win.size} px, fullscr={FULLSCR}")
+    # Raise process priority to reduce scheduler jitter on flips
+    # (on Linux, realtime scheduling needs e.g. `setcap cap_sys_nice=+ep` on the python binary)
+    try:
+        core.rush(True, realtime=True)
+    except Exception as e:
+        logging.warning(f"core.rush failed: {e}")
+
+    # Phase durations are counted in frames (vsync) rather than polled on the clock
+    refresh_hz = win.getActualFrameRate(nIdentical=20, nMaxFrames=200)
+    if refresh_hz is None:
+        refresh_hz = FALLBACK_REFRESH_HZ
+        logging.warning(f"Could not measure refresh rate, assuming {refresh_hz} Hz")
+    logging.info(f"Refresh rate: {refresh_hz:.2f} Hz")
+    n_frames_prime = frames_for(PRIME_TIME, refresh_hz)
+    n_frames_target = frames_for(TARGET_TIME, refresh_hz)
+    n_frames_resp = frames_for(RESP_WINDOW, refresh_hz)
+    n_frames_iti = frames_for(ITI_SECONDS, refresh_hz)
 
     # Create instructions
     instr = visual.TextStim(
@@ -129,10 +180,6 @@ def main():
     )
     logging.info("Experiment instructions prepared.")
 
-    # Prepare prime/target stimuli placeholders
-    prime_img = visual.ImageStim(win, image=None, size=None, interpolate=True)
-    target_stim = visual.TextStim(win, text='', height=60, color=COLOR_TARGET, font=FONT_NAME)
-
     # Fixation and response-window prompt
     fixation = visual.TextStim(win, text='+', height=60, color='black')
     question = visual.TextStim(win, text='?', height=60, color='black')
@@ -150,96 +197,108 @@ def main():
 
     # Build trials (full factorial: each target x each brand)
     logging.info("Building trial list...")
-    full, n_blocks, total_trials, trials_per_block = build_trials()
+    seed = SEED if SEED is not None else random.randrange(2**32)
+    rng = random.Random(seed)
+    logging.info(f"Seed: {seed}")
+    full, n_blocks, total_trials, trials_per_block = build_trials(rng)
+
+    # All ISIs drawn up front from the same seeded RNG, already in frames
+    isi_frames = [frames_for(rng.uniform(*ISI_INTERVAL), refresh_hz) for _ in full]
+
+    # One stimulus per distinct logo and per distinct target word, built up front so
+    # no texture upload or text layout happens inside a trial
+    prime_stims = {
+        bpath: visual.ImageStim(win, image=bpath, size=bsize, interpolate=True)
+        for bpath, bsize in {t["brand_path"]: t["brand_size"] for t in full}.items()
+    }
+    target_stims = {
+        word: visual.TextStim(win, text=word, height=60, color=COLOR_TARGET, font=FONT_NAME)
+        for word in {t["target"] for t in full}
+    }
 
     # Display instructions and wait for SPACE (or ESCAPE to quit)
     instr.draw()
     win.flip()
     kb.clearEvents()
-    event.clearEvents()
     kb.waitKeys(keyList=['space', 'escape'])
     if any(k.name == 'escape' for k in kb.getKeys(waitRelease=False)):
         win.close()
         core.quit()
 
-    # Create output CSV and write header
-    csv_create_header()
-
-    # Trial loop
-    for t_idx, t in enumerate(full):
-        prime_img.image = t["brand_path"]
-        prime_img.size = t["brand_size"]
-        prime_on = core.getTime()
-        kb.clearEvents()
-        event.clearEvents()
-
-        # Show PRIME (logo)
-        while (core.getTime() - prime_on) < PRIME_TIME:
-            prime_img.draw()
-            win.flip()
-
-        # Wait during ISI (fixation)
-        isi = random.uniform(*ISI_INTERVAL)
-        isi_start = core.getTime()
-        while (core.getTime() - isi_start) < isi:
-            fixation.draw()
-            win.flip()
-
-        # Show TARGET (word) → response window ("?")
-        target_stim.text = t['target']
-        target_on = core.getTime()
-        resp_deadline = target_on + TARGET_TIME + RESP_WINDOW
-
-        # For clean gating, drop any pre-target key noise
-        kb.clearEvents()
-        event.clearEvents()
-        resp_key = None
-        rt_ms_from_target = None
-        marker_sent = False
-
-        while core.getTime() < resp_deadline:
-            now = core.getTime()
-            elapsed = now - target_on
-
-            # Determine what to draw (target vs '?')
-            if elapsed < TARGET_TIME:
-                # During target: show target
-                target_stim.draw()
-                if not marker_sent:
-                    send_marker(win, TARGET_MARKER)  # on first target frame
-                    marker_sent = True
-            elif elapsed < TARGET_TIME + RESP_WINDOW:
-                # After target offset, response window: show '?'
-                question.draw()
-
-            win.flip()
-
-            # Accept keys only during response window
-            keys = kb.getKeys(keyList=[KEY_RELATED, KEY_UNRELATED, 'escape'], waitRelease=False)
-            if keys:
-                k = keys[0].name
-                if k == 'escape':
-                    win.close()
-                    core.quit()
-                if resp_key is None and (elapsed > TARGET_TIME) and (k in (KEY_RELATED, KEY_UNRELATED)):
-                    send_marker(win, RESP_MARKER)
-                    resp_key = k
-                    rt_ms_from_target = elapsed * 1000
-                    # NOTE: Keep drawing until resp_deadline for consistent timing; change to 'break' to end early
-                    # break
-
-        # Optional ITI
-        if ITI_SECONDS > 0:
-            iti_start = core.getTime()
-            while (core.getTime() - iti_start) < ITI_SECONDS:
-                fixation.draw()
+    # Create output CSV and write header; kept open for the whole session
+    with open(OUT_CSV, "w", newline="", encoding="utf-8", buffering=1 << 16) as log_fh:
+        log_writer = csv.writer(log_fh)
+        csv_create_header(log_writer, seed)
+
+        # No cyclic GC inside trials: move setup objects out of the scan, then collect
+        # only at block breaks (and after the loop)
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+        # Row timestamps are a single wall-clock anchor plus monotonic elapsed time
+        wall_anchor = datetime.now()
+        mono_anchor = core.getTime()
+
+        # Trial loop
+        for t_idx, t in enumerate(full):
+            prime_img = prime_stims[t["brand_path"]]
+            target_stim = target_stims[t["target"]]
+            kb.clearEvents()
+
+            # Show PRIME (logo); autoDraw redraws it on every flip
+            prime_img.autoDraw = True
+            for _ in range(n_frames_prime):
                 win.flip()
+            prime_img.autoDraw = False
+
+            # Wait during ISI (fixation)
+            fixation.autoDraw = True
+            for _ in range(isi_frames[t_idx]):
+                win.flip()
+            fixation.autoDraw = False
+
+            # Show TARGET (word) → response window ("?")
+            # For clean gating, drop any pre-target key noise
+            kb.clearEvents()
+            resp_key = None
+            rt_ms_from_target = None
+
+            send_marker(win, TARGET_MARKER)  # on first target frame
+            # Zero the keyboard clock on the target flip so key.rt is the RT from target onset
+            win.callOnFlip(kb.clock.reset)
+            target_stim.autoDraw = True
+            for frame in range(n_frames_target + n_frames_resp):
+                if frame == n_frames_target:
+                    # After target offset, response window: show '?'
+                    target_stim.autoDraw = False
+                    question.autoDraw = True
 
-        # Log trial result to CSV
-        with open(OUT_CSV, "a", newline="", encoding="utf-8") as fh:
-            w = csv.writer(fh)
-            w.writerow([
-                datetime.now().isoformat(timespec='milliseconds'),  # timestamp_iso
+                win.flip()
+                if frame == 0:
+                    target_on = core.getTime()
+                    # Same clock as the marker stream, so rows align with EEG without a clock-offset step
+                    target_lsl = local_clock() if USE_LSL else None
+            target_stim.autoDraw = False
+            question.autoDraw = False
+
+            # Key events stay queued with their timestamps, so read them once after the
+            # fixed-length window; accept the first key after target offset
+            keys = kb.getKeys(keyList=[KEY_RELATED, KEY_UNRELATED, 'escape'], waitRelease=False)
+            if any(k.name == 'escape' for k in keys):
+                win.close()
+                core.quit()
+            for k in keys:
+                if k.rt > TARGET_TIME:
+                    send_marker_for_key(kb, k, RESP_MARKER)
+                    resp_key = k.name
+                    rt_ms_from_target = k.rt * 1000
+                    break
+
+            # Log trial result to CSV
+            log_writer.writerow([
+                (wall_anchor + timedelta(seconds=target_on - mono_anchor)).isoformat(timespec='milliseconds'),  # timestamp_iso (target onset)
+                f"{target_lsl:.6f}" if target_lsl is not None else '',  # target_lsl_time
                 t_idx,  # trial_index
                 t['brand'], t['target'],  # brand, target
                 PRIME_TIME, TARGET_TIME, RESP_WINDOW,  # prime_time_s, target_time_s, resp_window_s
@@ -247,32 +306,41 @@ def main():
                 round(rt_ms_from_target, 2) if rt_ms_from_target is not None else '',  # rt_ms_from_target
             ])
 
-        # Block rest screen
-        trials_done = t_idx + 1
-        if trials_per_block and (trials_done % trials_per_block == 0) and (trials_done < total_trials):
-            current_block = trials_done // trials_per_block
-            rest_text.text = (
-                f"You can rest here.\n\n"
-                f"You can move around and blink now.\n\n"
-                f"{trials_done} trials done out of {total_trials}.\n"
-                f"Block {current_block} of {n_blocks} completed.\n\n"
-                f"Press SPACE to continue."
-            )
-            kb.clearEvents()
-            event.clearEvents()
-            while True:
+            # Rows collect in the file's 64 KiB buffer; push them to disk only every
+            # LOG_FLUSH_EVERY trials, between the response window and the next prime
+            if (t_idx + 1) % LOG_FLUSH_EVERY == 0:
+                log_fh.flush()
+
+            # Optional ITI
+            if n_frames_iti > 0:
+                fixation.autoDraw = True
+                for _ in range(n_frames_iti):
+                    win.flip()
+                fixation.autoDraw = False
+
+            # Block rest screen
+            trials_done = t_idx + 1
+            if trials_per_block and (trials_done % trials_per_block == 0) and (trials_done < total_trials):
+                current_block = trials_done // trials_per_block
+                rest_text.text = (
+                    f"You can rest here.\n\n"
+                    f"You can move around and blink now.\n\n"
+                    f"{trials_done} trials done out of {total_trials}.\n"
+                    f"Block {current_block} of {n_blocks} completed.\n\n"
+                    f"Press SPACE to continue."
+                )
+                # Static screen: draw and flip once, then block on the keyboard
                 rest_text.draw()
                 win.flip()
-                keys = kb.getKeys(keyList=['space', 'escape'], waitRelease=False)
-                if keys:
-                    if any(k.name == 'escape' for k in keys):
-                        win.close()
-                        core.quit()
-                    if any(k.name == 'space' for k in keys):
-                        kb.clearEvents()
-                        event.clearEvents()
-                        break
-                core.wait(0.01)
+                gc.collect()
+                kb.clearEvents()
+                keys = kb.waitKeys(keyList=['space', 'escape'])
+                if any(k.name == 'escape' for k in keys):
+                    win.close()
+                    core.quit()
+                kb.clearEvents()
+
+        gc.enable()
 
     # End of experiment screen
     end = visual.TextStim(
@@ -284,38 +352,38 @@ def main():
     end.draw()
     win.flip()
     kb.clearEvents()
-    while True:
-        keys = kb.getKeys(waitRelease=False)
-        if any(k.name in ('return', 'enter', 'escape') for k in keys):
-            break
-        core.wait(0.01)
+    kb.waitKeys(keyList=['return', 'enter', 'escape'], waitRelease=False)
 
+    core.rush(False)
     win.close()
     core.quit()
 
 
-def build_trials() -> tuple[list[dict], int, int, int]:
+def build_trials(rng: random.Random) -> tuple[list[dict], int, int, int]:
     brand_paths = resolve_brand_paths(BRAND_PATHS)
-    targets = [word for category in WORDLIST.values() for word in category]
-    targets = targets * REPEATS_PER_WORD  # Repeat each word as specified
-    full = []
-    for tgt in targets:
-        for bpath in brand_paths:
-            full.append({
-                "brand": os.path.splitext(os.path.basename(bpath))[0],
-                "brand_path": bpath,
-                "brand_size": fitted_size_for_image(bpath, PRIME_IMAGE_MAX),
-                "target": tgt,
-                # 'condition' and 'correct_key' intentionally omitted (unknown without labels)
-            })
+    targets = TARGET_WORDS * REPEATS_PER_WORD  # Repeat each word as specified
+    # Per-brand fields are computed once (one image header read per logo), not per trial
+    brands = [
+        (os.path.splitext(os.path.basename(bpath))[0], bpath, fitted_size_for_image(bpath, PRIME_IMAGE_MAX))
+        for bpath in brand_paths
+    ]
+    full = [
+        {
+            "brand": brand, "brand_path": bpath, "brand_size": bsize, "target": tgt,
+            # 'condition' and 'correct_key' intentionally omitted (unknown without labels)
+        }
+        for tgt in targets
+        for brand, bpath, bsize in brands
+    ]
 
     if len(full) == 0:
         raise RuntimeError("No trials to run (no targets or no valid logos).")
 
-    # Shuffle trials and limit to N_TRIALS if set
-    random.shuffle(full)
+    # Shuffle trials, or draw N_TRIALS of them if set (sample() already returns them in random order)
     if isinstance(N_TRIALS, int) and N_TRIALS > 0:
-        full = random.sample(full, k=min(N_TRIALS, len(full)))
+        full = rng.sample(full, k=min(N_TRIALS, len(full)))
+    else:
+        rng.shuffle(full)
     total_trials = len(full)
     logging.info(f"Trial list built. Total trials: {total_trials}")
 
@@ -328,13 +396,13 @@ def build_trials() -> tuple[list[dict], int, int, int]:
     return full, n_blocks, total_trials, trials_per_block
 
 
-def csv_create_header():
-    with open(OUT_CSV, "w", newline="", encoding="utf-8") as fh:
-        w = csv.writer(fh)
-        w.writerow([
-            "timestamp_iso", "trial_index", "brand", "target", "prime_time_s", "target_time_s", "resp_window_s",
-            "resp_key", "rt_ms_from_target"
-        ])
+def csv_create_header(w, seed):
+    w.writerow(["# SEED", seed])
+    w.writerow([])
+    w.writerow([
+        "timestamp_iso", "target_lsl_time", "trial_index", "brand", "target", "prime_time_s", "target_time_s", "resp_window_s",
+        "resp_key", "rt_ms_from_target"
+    ])
 
 
 if __name__ == "__main__":
@@ -16,16 +16,23 @@ Paradigm based on:
 
 USE_LSL = False  # Set to True to enable LSL markers for EEG
 
-if USE_LSL:
-    from pylsl import StreamInfo, StreamOutlet
-from psychopy import visual, core, event, logging, gui
+from psychopy import visual, core, logging, gui
 from psychopy.hardware import keyboard
 from PIL import Image
+import numpy as np
 import random
 import os
+import atexit
 import csv
-import math
-from datetime import datetime
+import functools
+import hashlib
+import pickle
+import queue
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 # =============================================================================
 # TIMING PARAMETERS (in seconds)
@@ -34,6 +41,8 @@ FIXATION_TIME = 0.000          # 1000 ms fixation cross
 BUNDLE_PREVIEW_TIME = 0.000    # 2000 ms bundle presentation (no price)
 EMPTY_SCREEN_INTERVAL = (0.400, 0.600)  # 400–600 ms empty screen (randomized)
 PRICE_RESPONSE_TIME = 1.000    # 4000 ms bundle with price (response window)
+ISI_SEED = None                # Seed for empty-screen jitters (None = draw one at startup)
+FALLBACK_REFRESH_HZ = 60.0     # Used if the refresh rate cannot be measured
 # Note: Only responses within 4s are valid for behavioral analyses
 
 # =============================================================================
@@ -57,7 +66,7 @@ PENALTY_THRESHOLDS = [
     (20, 20.0),   # <20 bundles bought → lose ₾20
     (25, 10.0),   # 20-24 bundles → lose ₾10
     (30, 5.0),    # 25-29 bundles → lose ₾5
-    (float('inf'), 0.0)  # ≥30 bundles → no penalty
+    (N_TRIALS_TOTAL + 1, 0.0)  # ≥30 bundles → no penalty (bound above any possible count)
 ]
 
 # =============================================================================
@@ -103,6 +112,15 @@ MARKER_BUNDLE_PRICE_ZP = 33
 MARKER_RESPONSE_BUY = 41
 MARKER_RESPONSE_NOBUY = 42
 MARKER_NO_RESPONSE = 50
+MARKER_BY_CONDITION = {
+    'NP': MARKER_BUNDLE_PRICE_NP,
+    'LP': MARKER_BUNDLE_PRICE_LP,
+    'ZP': MARKER_BUNDLE_PRICE_ZP,
+}
+MARKER_BY_RESPONSE = {
+    'BUY': MARKER_RESPONSE_BUY,
+    'NOBUY': MARKER_RESPONSE_NOBUY,
+}
 
 # =============================================================================
 # FILE PATHS
@@ -134,66 +152,82 @@ OUT_CSV = os.path.join(BASE_DIR, f"bundle_pricing_{TIMESTAMP}.csv")
 #       ...
 MEDIA_DIR = os.path.join(BASE_DIR, "media")
 BUNDLES_DIR = os.path.join(MEDIA_DIR, "bundles")
+PLACEHOLDER_DIR = os.path.join(BASE_DIR, "temp_images")  # Cached placeholders (kept across runs)
 
 # =============================================================================
 # BUNDLE DEFINITIONS
 # =============================================================================
-# Each bundle: (bundle_id, focal_product_name, tiein_product_name, 
-#               base_focal_price, base_tiein_price)
+# Bundles are defined in bundles.tsv next to this script, one row per bundle:
+#   id, focal_name, tiein_name, focal_base, tiein_base
 # Names are saved to CSV but NOT displayed (only images are shown)
 # Prices should be mean of two online shops as per study design
 
-BUNDLES = [
-    # Format: (id, focal_name, tiein_name, focal_base_price, tiein_base_price)
-    (1, "Wireless Mouse (Dell WM126 Black)", "Gembird mouse Pad Black", 51.12, 3.0),
-    (2, "2E Membrane keyboard KG350 Gaming", "Keyboard Cover", 55.0, 15.0),
-    (3, "Hoco J87 Tacker PD20W+QC3.0 Power Bank (10000mAh) Black", "Hoco X86 Micro Spear silicone charging data cable Black", 49.0, 9.0),
-    (4, "Proove Wireless Earphones Mainstream TWS white", "BLACK CASE FOR AIRPODS 3", 58.0, 12.0),
-    (5, "Webcam (HD camera mini packing)", "RK-12 LED Light", 43.0, 16.0),
-    (6, "Vention TGKBD Type-C to 4-Port", "Ugreen USB-C to USB-C PD Fast Charging Cable", 49.0, 19.0),
-    (7, "Electric Kettle (ADLER AD1224)", "Tea Cup with Filter", 45.0, 7.59),
-    (8, "Electric Stove (ARNICA ID 77610)", "Pan (HASCEVHER PICCOLO ID 100424)", 38.0, 14.2),
-    (9, "Rice (N1 Long Grain 900g)", "Spices (Black Pepper)", 4.29, 1.25),
-    (10, "Olive Oil (Extra Virgin 0.5L)", "Salad Bowl", 25.0, 4.0),
-    (11, "Bacon", "Eggs", 11.25, 4.75),
-    (12, "Pesto", "Pasta Barilla (Fussili)", 23.4, 5.95),
-    (13, "Cavear", "Butter (President)", 49.95, 9.95),
-    (14, "Sausage (780g)", "Mustard", 14.5, 1.75),
-    (15, "Nuts (Peanuts 120g)", "Dried Fruits", 11.95, 4.5),
-    (16, "Chocolate Set (90g)", "Coffee", 16.95, 4.8),
-    (17, "Jackobs", "Coffee mug", 35.0, 17.68),
-    (18, "Red Wine 'Gonadze' Khvanchkara (Semi-Sweet) 0.75L", "Wine Bottle Opener OEM TM39002", 39.95, 14.0),
-    (19, "Whiskey (0.75L)", "Leonardo Swing Whisky Glass", 59.9, 9.5),
-    (20, "Arak (Georgian Brandy)", "Energy Drink Red Bull (250ml)", 50.0, 5.95),
-    (21, "Tea Box", "Greenfield Tea", 39.9, 4.95),
-    (22, "Beer", "Peanuts", 14.0, 3.2),
-    (23, "Toilet Paper (Selpak 32pcs)", "Wet Wipes", 32.5, 6.8),
-    (24, "Fito - Nourishment Shampoo for Dry Hair Sulfate-Free 250ml", "Fito - Nourishment Conditioner for Dry Hair 175ml", 30.95, 24.95),
-    (25, "Liquid Soap Dispenser", "Liquid Soap", 49.2, 6.5),
-    (26, "Razor", "Shaving Foam", 59.9, 9.95),
-    (27, "Nail Care Set", "Tweezers", 62.89, 5.95),
-    (28, "Coconut Body Lotion", "Soap", 45.0, 19.0),
-    (29, "Electric Toothbrush Bicofident", "Toothpaste (LACALUT 75ml)", 43.5, 10.56),
-    (30, "Floor Cleaning Mop", "Mop Replacement Head", 62.0, 7.4),
-    (31, "Designworks Ink - Notebook Twin Wire", "Pen", 49.99, 3),
-    (32, "Sapiens", "Bookmark", 24.9, 3.0),
-    (33, "Board", "Markers", 49.0, 4.75),
-    (34, "Cutting Board", "Knife", 44.9, 19.0),
-    (35, "Candlestick", "Candle", 39.9, 8.0),
-    (36, "Lunch container", "Lunch Bag", 44.0, 15.0),
-    (37, "FAIRY Dishwashing Liquid Lemon 1.5L", "Dishwashing Sponge VILEDA", 11.55, 2.25),
-    (38, "Table Lamp", "Light Bulb", 57.0, 12.0),
-    (39, "Hascevher 28cm Granite Pan without Lid", "Drevotvar 29.5cm Wooden Spoon", 34.0, 5.3),
-    (40, "Flashlight", "Battery", 67.0, 5),
-]
+BUNDLES_TSV = os.path.join(BASE_DIR, "bundles.tsv")
+BUNDLES_CACHE = os.path.join(BASE_DIR, "bundles.pkl")  # Parsed copy of BUNDLES_TSV
+
+
+def load_bundles(path, cache_path=BUNDLES_CACHE):
+    """
+    Load bundle definitions from a TSV file with header
+    id, focal_name, tiein_name, focal_base, tiein_base.
+    The parsed table is pickled to 'cache_path' and reused while it is newer than the TSV.
+    Returns a list of (id, focal_name, tiein_name, focal_base, tiein_base) tuples.
+    """
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            with open(cache_path, "rb") as fh:
+                return pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    
+    with open(path, newline="", encoding="utf-8") as fh:
+        rows = list(csv.reader(fh, delimiter="\t"))[1:]
+    bundles = [(int(r[0]), r[1], r[2], float(r[3]), float(r[4])) for r in rows]
+    
+    try:
+        with open(cache_path, "wb") as fh:
+            pickle.dump(bundles, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        logging.warning(f"Could not write bundle cache {cache_path}: {e}")
+    return bundles
+
+
+BUNDLES = load_bundles(BUNDLES_TSV)
 
 # Ensure we have exactly N_BUNDLES
 assert len(BUNDLES) == N_BUNDLES, f"Expected {N_BUNDLES} bundles, got {len(BUNDLES)}"
 
+# Column (SoA) views of the bundle table for price math
+FOCAL_BASE = np.array([b[3] for b in BUNDLES], dtype=np.float64)
+TIEIN_BASE = np.array([b[4] for b in BUNDLES], dtype=np.float64)
+
+# Display prices (rounded to 2 decimals) indexed by [bundle_idx, condition_idx]
+CONDITION_INDEX = {'NP': 0, 'LP': 1, 'ZP': 2}
+_NP_FACTOR = 1 - DISCOUNT_PERCENT / 100.0
+_NP_TOTAL = (FOCAL_BASE + TIEIN_BASE) * _NP_FACTOR
+_FOCAL = np.column_stack([FOCAL_BASE * _NP_FACTOR, _NP_TOTAL, _NP_TOTAL])
+_TIEIN = np.column_stack([
+    TIEIN_BASE * _NP_FACTOR,
+    np.full(N_BUNDLES, LOW_TOKEN_PRICE),
+    np.zeros(N_BUNDLES),
+])
+FINAL_FOCAL = np.round(_FOCAL, 2)
+FINAL_TIEIN = np.round(_TIEIN, 2)
+FINAL_TOTAL = np.round(_FOCAL + _TIEIN, 2)
+
 # =============================================================================
 # LSL SETUP
 # =============================================================================
-if USE_LSL:
+# pylsl loads liblsl on import, so the outlet is created on a background
+# thread (see start_lsl) while the window is being opened.
+outlet = None
+local_clock = None
+lsl_error = None  # exception raised by _init_lsl, re-raised in main() after the join
+
+
+def _init_lsl():
+    global outlet, local_clock
+    from pylsl import StreamInfo, StreamOutlet, local_clock as _local_clock
     info = StreamInfo(
         name='PsychopyMarkerStream',
         type='Markers',
@@ -202,14 +236,88 @@ if USE_LSL:
         source_id='bundle_pricing_erp'
     )
     outlet = StreamOutlet(info)
+    local_clock = _local_clock
+
+
+def _init_lsl_thread():
+    global lsl_error
+    try:
+        _init_lsl()
+    except BaseException as e:
+        lsl_error = e
+
+
+def start_lsl():
+    """Start LSL outlet creation in the background. Returns the thread (or None)."""
+    if not USE_LSL:
+        return None
+    thread = threading.Thread(target=_init_lsl_thread, name='lsl-init', daemon=True)
+    thread.start()
+    return thread
 
 logging.console.setLevel(logging.INFO)
 
 
+# Markers stamped on flip, pushed to LSL in one chunk during the empty screen
+PENDING_MARKERS = []
+
+
+def _queue_marker(value):
+    PENDING_MARKERS.append((local_clock(), int(value)))
+
+
 def send_marker(win, value):
-    """Send a marker value exactly on next flip."""
+    """Timestamp a marker value exactly on next flip (pushed later by flush_markers)."""
     if USE_LSL:
-        win.callOnFlip(outlet.push_sample, [int(value)])
+        win.callOnFlip(_queue_marker, value)
+
+
+def flush_markers():
+    """Push all pending markers with their flip timestamps (also called before any early quit)."""
+    if USE_LSL and PENDING_MARKERS:
+        # One push_sample per marker: per-sample timestamps in push_chunk need a recent pylsl
+        for t, m in PENDING_MARKERS:
+            outlet.push_sample([m], t)
+        PENDING_MARKERS.clear()
+
+
+def frames_for(duration, refresh_hz):
+    """Convert a duration in seconds to a whole number of frames at 'refresh_hz'."""
+    return int(round(duration * refresh_hz))
+
+
+def price_positions(focal_size, tiein_size):
+    """
+    Compute price text positions for a pair of fitted image sizes.
+    Prices sit PRICE_OFFSET_BELOW_IMAGE below the lowest image bottom,
+    horizontally centered under each image (window units are pixels).
+    Returns: (focal_price_pos, tiein_price_pos)
+    """
+    # Images are vertically centered at IMAGE_CENTER_Y, so bottom = center_y - height/2
+    lowest_bottom_y = IMAGE_CENTER_Y - max(focal_size[1], tiein_size[1]) / 2.0
+    price_y = lowest_bottom_y - PRICE_OFFSET_BELOW_IMAGE
+    # Focal image is anchored at its right edge, tie-in image at its left edge
+    focal_center_x = FOCAL_RIGHT_EDGE_X - (focal_size[0] / 2.0)
+    tiein_center_x = TIEIN_LEFT_EDGE_X + (tiein_size[0] / 2.0)
+    return (focal_center_x, price_y), (tiein_center_x, price_y)
+
+
+def hold_static(win, kb, stims, n_frames, refresh_hz):
+    """
+    Show 'stims' for n_frames without redrawing the unchanged frame every refresh.
+    Draws and flips once, then sleeps until half a frame before the phase ends,
+    so the next flip lands on the retrace n_frames after onset.
+    """
+    if n_frames <= 0:
+        return
+    for stim in stims:
+        stim.draw()
+    win.flip()
+    core.wait((n_frames - 0.5) / refresh_hz)
+    if kb.getKeys(keyList=['escape'], waitRelease=False):
+        flush_markers()
+        win.close()
+        core.quit()
 
 
 def get_participant_info():
@@ -229,14 +337,62 @@ def get_participant_info():
         core.quit()
 
 
+def image_size(img_path):
+    """
+    Read (w,h) of a PNG, GIF, BMP or JPEG from its header without decoding pixels.
+    Falls back to PIL for other formats or unexpected headers.
+    """
+    with open(img_path, 'rb') as fh:
+        head = fh.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] == b'BM' and len(head) >= 26:
+            w, h = struct.unpack('<ii', head[18:26])
+            return w, abs(h)
+        if head[:2] == b'\xff\xd8':
+            # Walk JPEG segments until a start-of-frame marker (SOF0..SOF15, except DHT/JPG/DAC)
+            fh.seek(2)
+            # Anything unexpected (truncated segment, scan data before a frame header) goes to PIL
+            while True:
+                if fh.read(1) != b'\xff':
+                    break
+                code = fh.read(1)
+                while code == b'\xff':  # fill bytes may pad a marker
+                    code = fh.read(1)
+                if not code:
+                    break
+                code = code[0]
+                if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                    continue
+                if code in (0xD9, 0xDA):  # EOI / SOS
+                    break
+                seg = fh.read(2)
+                if len(seg) < 2:
+                    break
+                seg_len = struct.unpack('>H', seg)[0]
+                if seg_len < 2:
+                    break
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    sof = fh.read(5)
+                    if len(sof) < 5:
+                        break
+                    h, w = struct.unpack('>xHH', sof)
+                    return w, h
+                fh.seek(seg_len - 2, os.SEEK_CUR)
+    with Image.open(img_path) as im:
+        return im.size
+
+
+@functools.lru_cache(maxsize=256)
 def fitted_size_for_image(img_path, max_size):
     """
     Compute (w,h) that fits 'img_path' inside 'max_size' while preserving aspect ratio.
-    max_size is (max_w, max_h) in pixels.
+    max_size is a (max_w, max_h) tuple in pixels. Results are cached per (path, max_size).
     """
     try:
-        with Image.open(img_path) as im:
-            w, h = im.size
+        w, h = image_size(img_path)
         max_w, max_h = max_size
         scale = min(max_w / float(w), max_h / float(h))
         new_w = max(1, int(round(w * scale)))
@@ -244,47 +400,97 @@ def fitted_size_for_image(img_path, max_size):
         return new_w, new_h
     except Exception as e:
         logging.warning(f"Could not read image {img_path}: {e}")
-        return max_size  # Fallback to max size
+        return tuple(max_size)  # Fallback to max size
+
+
+def load_fitted_image(img_path, max_size):
+    """
+    Decode 'img_path' once and resize it to fit inside 'max_size' (aspect preserved).
+    Returns an RGB PIL image, or the path itself if it could not be decoded.
+    """
+    size = fitted_size_for_image(img_path, max_size)
+    try:
+        with Image.open(img_path) as im:
+            return im.convert('RGB').resize(size, Image.LANCZOS)
+    except Exception as e:
+        logging.warning(f"Could not preload image {img_path}: {e}")
+        return img_path
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')  # In order of preference
+IMAGE_ROLES = ('focal', 'tiein')
+
+
+def _offer_image(table, key, path, ext):
+    """Keep 'path' in table[key] unless a file with a preferred extension is already there."""
+    rank = IMAGE_EXTENSIONS.index(ext)
+    if key not in table or rank < table[key][0]:
+        table[key] = (rank, path)
+
+
+@functools.lru_cache(maxsize=None)
+def scan_bundle_dir(bundles_dir=BUNDLES_DIR):
+    """
+    Walk 'bundles_dir' once and collect product images for both layouts.
+    Returns two dicts mapping (bundle_id, role) -> path: one for the folder
+    layout (bundle_XX/focal.ext) and one for the flat layout (bundle_XX_focal.ext).
+    """
+    folder, flat = {}, {}
+    try:
+        entries = list(os.scandir(bundles_dir))
+    except OSError:
+        return {}, {}
+    
+    for entry in entries:
+        stem, ext = os.path.splitext(entry.name)
+        ext = ext.lower()  # 'focal.JPG' counts, as it did with os.path.exists on Windows/macOS
+        parts = stem.split('_')
+        if len(parts) < 2 or parts[0] != 'bundle' or not parts[1].isdigit():
+            continue
+        bundle_id = int(parts[1])
+        if entry.is_dir() and len(parts) == 2:
+            for sub in os.scandir(entry.path):
+                role, sub_ext = os.path.splitext(sub.name)
+                sub_ext = sub_ext.lower()
+                if sub.is_file() and role in IMAGE_ROLES and sub_ext in IMAGE_EXTENSIONS:
+                    _offer_image(folder, (bundle_id, role), sub.path, sub_ext)
+        elif entry.is_file() and len(parts) == 3 and parts[2] in IMAGE_ROLES and ext in IMAGE_EXTENSIONS:
+            _offer_image(flat, (bundle_id, parts[2]), entry.path, ext)
+    
+    return ({k: p for k, (_, p) in folder.items()},
+            {k: p for k, (_, p) in flat.items()})
 
 
 def get_bundle_image_paths(bundle_id):
     """
     Get image paths for focal and tie-in products of a bundle.
-    Tries multiple folder structures and file extensions.
+    Prefers the folder structure over the flat structure (see scan_bundle_dir).
     Returns: (focal_path, tiein_path) or (None, None) if not found
     """
-    extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']
-    
-    # Try folder structure: bundles/bundle_XX/focal.ext, bundles/bundle_XX/tiein.ext
-    bundle_folder = os.path.join(BUNDLES_DIR, f"bundle_{bundle_id:02d}")
-    if os.path.isdir(bundle_folder):
-        focal_path = None
-        tiein_path = None
-        for ext in extensions:
-            if focal_path is None and os.path.exists(os.path.join(bundle_folder, f"focal{ext}")):
-                focal_path = os.path.join(bundle_folder, f"focal{ext}")
-            if tiein_path is None and os.path.exists(os.path.join(bundle_folder, f"tiein{ext}")):
-                tiein_path = os.path.join(bundle_folder, f"tiein{ext}")
+    for table in scan_bundle_dir():
+        focal_path = table.get((bundle_id, 'focal'))
+        tiein_path = table.get((bundle_id, 'tiein'))
         if focal_path and tiein_path:
             return focal_path, tiein_path
-    
-    # Try flat structure: bundles/bundle_XX_focal.ext, bundles/bundle_XX_tiein.ext
-    for ext in extensions:
-        focal_path = os.path.join(BUNDLES_DIR, f"bundle_{bundle_id:02d}_focal{ext}")
-        tiein_path = os.path.join(BUNDLES_DIR, f"bundle_{bundle_id:02d}_tiein{ext}")
-        if os.path.exists(focal_path) and os.path.exists(tiein_path):
-            return focal_path, tiein_path
-    
     return None, None
 
 
 def create_placeholder_image(width, height, text, bg_color=(200, 200, 200), text_color=(50, 50, 50)):
     """
     Create a placeholder image with text (for when actual product images aren't available).
-    Returns the path to the created temporary image.
+    Files are named by a hash of their content and kept across runs, so an
+    existing placeholder is reused without rendering.
+    Returns the path to the placeholder image.
     """
     from PIL import ImageDraw, ImageFont
     
+    key = hashlib.blake2s(f"{width}x{height}:{text}:{bg_color}:{text_color}".encode("utf-8"),
+                          digest_size=8).hexdigest()
+    os.makedirs(PLACEHOLDER_DIR, exist_ok=True)
+    temp_path = os.path.join(PLACEHOLDER_DIR, f"placeholder_{key}.png")
+    if os.path.exists(temp_path):
+        return temp_path
+    
     img = Image.new('RGB', (width, height), color=bg_color)
     draw = ImageDraw.Draw(img)
     
@@ -305,15 +511,20 @@ def create_placeholder_image(width, height, text, bg_color=(200, 200, 200), text
     # Draw border
     draw.rectangle([0, 0, width-1, height-1], outline=(100, 100, 100), width=2)
     
-    # Save to temp file
-    temp_dir = os.path.join(BASE_DIR, "temp_images")
-    os.makedirs(temp_dir, exist_ok=True)
-    temp_path = os.path.join(temp_dir, f"placeholder_{text.replace(' ', '_')[:20]}_{random.randint(1000,9999)}.png")
-    img.save(temp_path)
+    # Render to a temporary name and rename, so an interrupted or concurrent
+    # write never leaves a truncated PNG under the cached name
+    fd, tmp_name = tempfile.mkstemp(suffix='.png', dir=PLACEHOLDER_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            img.save(fh, format='PNG')
+        os.replace(tmp_name, temp_path)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
     return temp_path
 
 
-def calculate_prices(bundle, condition):
+def calculate_prices(bundle_idx, condition):
     """
     Calculate prices for focal and tie-in products based on condition.
     
@@ -321,37 +532,51 @@ def calculate_prices(bundle, condition):
     ZP (Zero Price): Tie-in free, focal adjusted so total = NP total
     LP (Low Price): Tie-in at ₾0.1, focal same as ZP focal
     
+    Prices are looked up in the precomputed (already rounded) FINAL_* tables.
     Returns: (focal_price, tiein_price, total_price)
     """
-    _, _, _, base_focal, base_tiein = bundle
-    base_total = base_focal + base_tiein
-    
-    if condition == 'NP':
-        # 20% discount on bundle
-        discount = base_total * (DISCOUNT_PERCENT / 100.0)
-        total = base_total - discount
-        # Distribute discount proportionally
-        focal_price = base_focal * (1 - DISCOUNT_PERCENT / 100.0)
-        tiein_price = base_tiein * (1 - DISCOUNT_PERCENT / 100.0)
-    
-    elif condition == 'ZP':
-        # Tie-in is free, total same as NP
-        np_total = base_total * (1 - DISCOUNT_PERCENT / 100.0)
-        tiein_price = 0.0
-        focal_price = np_total  # Focal absorbs the cost
-        total = np_total
-    
-    elif condition == 'LP':
-        # Tie-in at ₾0.1, focal same as ZP focal
-        np_total = base_total * (1 - DISCOUNT_PERCENT / 100.0)
-        tiein_price = LOW_TOKEN_PRICE
-        focal_price = np_total  # Same as ZP focal
-        total = focal_price + tiein_price
-    
-    else:
+    if condition not in CONDITION_INDEX:
         raise ValueError(f"Unknown condition: {condition}")
+    cond_idx = CONDITION_INDEX[condition]
+    return (float(FINAL_FOCAL[bundle_idx, cond_idx]),
+            float(FINAL_TIEIN[bundle_idx, cond_idx]),
+            float(FINAL_TOTAL[bundle_idx, cond_idx]))
+
+
+def find_violations(bundle_ids, min_gap=3):
+    """Return positions whose bundle repeats one of the previous min_gap - 1 bundles."""
+    ids = np.asarray(bundle_ids, dtype=np.int32)
+    bad = np.zeros(len(ids), dtype=bool)
+    for lag in range(1, min_gap):
+        bad[lag:] |= ids[lag:] == ids[:-lag]
+    return np.flatnonzero(bad)
+
+
+def schedule_with_constraint(trials, min_gap=3, max_restarts=100):
+    """
+    Order trials so the same bundle never appears within 'min_gap' consecutive trials.
+    Each position is drawn uniformly, without replacement, from the remaining
+    trials whose bundle was not used in the last min_gap - 1 positions (so bundles
+    with more trials left are proportionally more likely); a dead end restarts
+    the draw.
+    """
+    for attempt in range(max_restarts):
+        pool = list(trials)
+        ordered = []
+        while pool:
+            recent = {t['bundle_id'] for t in ordered[-(min_gap - 1):]}
+            eligible = [i for i, t in enumerate(pool) if t['bundle_id'] not in recent]
+            if not eligible:
+                break
+            i = random.choice(eligible)
+            pool[i], pool[-1] = pool[-1], pool[i]
+            ordered.append(pool.pop())
+        else:
+            logging.info(f"Scheduling completed after {attempt + 1} attempt(s)")
+            return ordered
     
-    return round(focal_price, 2), round(tiein_price, 2), round(total, 2)
+    logging.warning(f"Could not satisfy constraint after {max_restarts} attempts, using plain shuffle")
+    return random.sample(trials, len(trials))
 
 
 def build_trials():
@@ -361,23 +586,18 @@ def build_trials():
     - Split into 3 blocks of 45 trials
     - Same bundle cannot appear within 3 consecutive trials
     
-    Uses efficient iterative repair algorithm with guaranteed O(n) complexity.
-    
-    Why this is efficient:
-    - With 45 bundles and only 3 occurrences each, the constraint is sparse
-    - The probability of random shuffle satisfying constraint is high (~90%+)
-    - Iterative repair fixes violations locally in O(1) per violation
-    - Worst case: O(n) repairs, each O(n) to find swap target = O(n²)
-    - Average case: Very few repairs needed after initial shuffle
+    Uses a constructive scheduler (see schedule_with_constraint): each position
+    is filled with a bundle not used in the previous 2 positions, restarting
+    on the rare dead end.
     """
     # Create all trial combinations
     all_trials = []
-    for bundle in BUNDLES:
+    for bundle_idx, bundle in enumerate(BUNDLES):
+        # Image paths are shared by all conditions of a bundle
+        focal_img, tiein_img = get_bundle_image_paths(bundle[0])
+        
         for condition in PRICE_CONDITIONS:
-            focal_price, tiein_price, total_price = calculate_prices(bundle, condition)
-            
-            # Get image paths
-            focal_img, tiein_img = get_bundle_image_paths(bundle[0])
+            focal_price, tiein_price, total_price = calculate_prices(bundle_idx, condition)
             
             all_trials.append({
                 'bundle_id': bundle[0],
@@ -389,122 +609,86 @@ def build_trials():
                 'focal_price': focal_price,
                 'tiein_price': tiein_price,
                 'total_price': total_price,
+                'focal_price_str': format_price(focal_price),
+                'tiein_price_str': format_price(tiein_price),
             })
     
-    def has_violation_at(trials, i):
-        """Check if position i violates the 3-consecutive constraint."""
-        if i < 0 or i >= len(trials):
-            return False
-        bundle_id = trials[i]['bundle_id']
-        # Check if same bundle appears at i-1, i, or i+1, i+2
-        for offset in [-2, -1, 1, 2]:
-            j = i + offset
-            if 0 <= j < len(trials) and j != i:
-                if trials[j]['bundle_id'] == bundle_id:
-                    # Check if they're within 3 consecutive
-                    if abs(offset) <= 2:
-                        return True
-        return False
-    
-    def find_valid_swap(trials, i):
-        """Find a valid position to swap with position i to fix violation."""
-        bundle_id = trials[i]['bundle_id']
-        # Try random positions first for better distribution
-        indices = list(range(len(trials)))
-        random.shuffle(indices)
-        
-        for j in indices:
-            if abs(i - j) <= 2:  # Skip nearby positions
-                continue
-            
-            # Check if swapping would create new violations
-            trial_j_id = trials[j]['bundle_id']
-            
-            # Temporarily swap and check
-            trials[i], trials[j] = trials[j], trials[i]
-            
-            # Check if swap fixes without creating new violations
-            ok = True
-            for pos in [i-2, i-1, i, i+1, i+2, j-2, j-1, j, j+1, j+2]:
-                if 0 <= pos < len(trials):
-                    if has_violation_at(trials, pos):
-                        ok = False
-                        break
-            
-            # Swap back
-            trials[i], trials[j] = trials[j], trials[i]
-            
-            if ok:
-                return j
-        
-        return None
-    
-    def shuffle_with_constraint(trials, max_repair_passes=50):
-        """Shuffle trials and repair violations iteratively."""
-        shuffled = trials.copy()
-        random.shuffle(shuffled)
-        
-        for pass_num in range(max_repair_passes):
-            violations_fixed = 0
-            
-            for i in range(len(shuffled)):
-                if has_violation_at(shuffled, i):
-                    j = find_valid_swap(shuffled, i)
-                    if j is not None:
-                        shuffled[i], shuffled[j] = shuffled[j], shuffled[i]
-                        violations_fixed += 1
-            
-            # Check if all violations are fixed
-            all_ok = True
-            for i in range(len(shuffled)):
-                if has_violation_at(shuffled, i):
-                    all_ok = False
-                    break
-            
-            if all_ok:
-                logging.info(f"Shuffling completed after {pass_num + 1} repair passes")
-                return shuffled
-        
-        logging.warning(f"Could not fully satisfy constraint after {max_repair_passes} passes")
-        return shuffled
-    
-    # Shuffle trials with constraint
-    shuffled_trials = shuffle_with_constraint(all_trials)
+    # Order trials with constraint
+    shuffled_trials = schedule_with_constraint(all_trials)
+    violations = find_violations([t['bundle_id'] for t in shuffled_trials])
+    if len(violations):
+        logging.warning(f"{len(violations)} trials violate the bundle spacing constraint: {violations.tolist()}")
     
     logging.info(f"Built {len(shuffled_trials)} trials in {N_BLOCKS} blocks")
     return shuffled_trials
 
 
-def create_csv_header(selected_bundle_id):
-    """Create output CSV with header and metadata."""
-    with open(OUT_CSV, "w", newline="", encoding="utf-8") as fh:
+def create_csv_header(selected_bundle_id, isi_seed):
+    """
+    Create output CSV with header and metadata.
+    Returns the open file handle (see start_csv_writer for the trial rows).
+    """
+    fh = open(OUT_CSV, "w", newline="", encoding="utf-8")
+    w = csv.writer(fh)
+    # Metadata rows
+    w.writerow(["# SELECTED_BUNDLE_FOR_SHIPPING", selected_bundle_id])
+    w.writerow(["# ISI_SEED", isi_seed])
+    w.writerow([])
+    # Header
+    w.writerow([
+        "timestamp_iso",
+        "participant_id",
+        "age",
+        "response_group",
+        "trial_index",
+        "block",
+        "bundle_id",
+        "focal_product",
+        "tiein_product",
+        "condition",
+        "focal_price",
+        "tiein_price",
+        "total_price",
+        "allocation_per_trial",
+        "response_key",
+        "response",  # BUY or NOBUY
+        "rt_ms",
+        "valid_response",  # 1 if response within 4s, 0 otherwise
+        "is_selected_bundle",  # 1 if this is the randomly selected bundle
+        "bundles_bought_cumulative",
+    ])
+    fh.flush()
+    return fh
+
+
+def start_csv_writer(fh):
+    """
+    Write CSV rows to 'fh' from a background thread so the trial loop never blocks on disk.
+    Returns (rows, stop): put row lists on the 'rows' queue; stop() writes any queued
+    rows, closes the file and is also registered to run at interpreter exit.
+    """
+    rows = queue.Queue()
+    
+    def _drain():
         w = csv.writer(fh)
-        # Metadata row
-        w.writerow(["# SELECTED_BUNDLE_FOR_SHIPPING", selected_bundle_id])
-        w.writerow([])
-        # Header
-        w.writerow([
-            "timestamp_iso",
-            "participant_id",
-            "age",
-            "response_group",
-            "trial_index",
-            "block",
-            "bundle_id",
-            "focal_product",
-            "tiein_product",
-            "condition",
-            "focal_price",
-            "tiein_price",
-            "total_price",
-            "allocation_per_trial",
-            "response_key",
-            "response",  # BUY or NOBUY
-            "rt_ms",
-            "valid_response",  # 1 if response within 4s, 0 otherwise
-            "is_selected_bundle",  # 1 if this is the randomly selected bundle
-            "bundles_bought_cumulative",
-        ])
+        while True:
+            row = rows.get()
+            if row is None:
+                break
+            w.writerow(row)
+            fh.flush()
+        fh.close()
+    
+    thread = threading.Thread(target=_drain, name='csv-writer', daemon=True)
+    thread.start()
+    
+    def stop():
+        if thread.is_alive():
+            rows.put(None)
+            thread.join()
+    
+    atexit.register(stop)
+    return rows, stop
 
 
 def calculate_penalty(bundles_bought):
@@ -515,6 +699,19 @@ def calculate_penalty(bundles_bought):
     return 0.0
 
 
+def update_trial_state(bundles_bought, response, rt_ms, is_selected):
+    """
+    Update purchase tracking after one trial (no PsychoPy objects involved).
+    Only BUY responses within the 4 s window count as purchases.
+    Returns: (valid_response, bundles_bought, selected_bought)
+    """
+    valid_response = 1 if (rt_ms is not None and rt_ms < 4000) else 0
+    bought = response == 'BUY' and valid_response
+    if bought:
+        bundles_bought += 1
+    return valid_response, bundles_bought, bool(bought and is_selected)
+
+
 def format_price(price):
     """
     Format price for display using Georgian Lari symbol (₾).
@@ -556,19 +753,43 @@ def main():
     
     all_resp_keys = buy_keys + nobuy_keys
     
-    # Initialize window
+    # Initialize window (LSL outlet is created concurrently)
+    lsl_thread = start_lsl()
     win = visual.Window(size=WIN_SIZE, units='pix', color=BG_COLOR, fullscr=FULLSCR)
-    kb = keyboard.Keyboard()
+    if lsl_thread is not None:
+        lsl_thread.join()
+        if lsl_error is not None:
+            # Fail at startup (e.g. pylsl/liblsl missing), not at the first marker
+            win.close()
+            raise lsl_error
+    # Raise process priority to reduce scheduler jitter on flips
+    try:
+        core.rush(True, realtime=True)
+    except Exception as e:
+        logging.warning(f"core.rush failed: {e}")
+    kb = keyboard.Keyboard(backend='ptb', clock=core.Clock())
     logging.info(f"Window initialized: {win.size} px, fullscr={FULLSCR}")
+    
+    # Phase durations are counted in frames (vsync) rather than polled on the clock
+    refresh_hz = win.getActualFrameRate(nIdentical=20, nMaxFrames=200)
+    if refresh_hz is None:
+        refresh_hz = FALLBACK_REFRESH_HZ
+        logging.warning(f"Could not measure refresh rate, assuming {refresh_hz} Hz")
+    logging.info(f"Refresh rate: {refresh_hz:.2f} Hz")
+    n_frames_fixation = frames_for(FIXATION_TIME, refresh_hz)
+    n_frames_preview = frames_for(BUNDLE_PREVIEW_TIME, refresh_hz)
+    n_frames_price = frames_for(PRICE_RESPONSE_TIME, refresh_hz)
     logging.info(f"Participant: {participant_id}, Group: {response_group}")
     
     # Create visual stimuli
     fixation = visual.TextStim(win, text='+', height=60, color='black', font=FONT_NAME)
     
-    # Image stimuli for products (will be updated per trial)
-    # Positions will be calculated dynamically based on image sizes
-    focal_img_stim = visual.ImageStim(win, image=None, pos=(0, IMAGE_CENTER_Y), size=None, anchor='right')
-    tiein_img_stim = visual.ImageStim(win, image=None, pos=(0, IMAGE_CENTER_Y), size=None, anchor='left')
+    # Image stimuli for products are created once per image after the trials are built
+    # Focal image right edge at FOCAL_RIGHT_EDGE_X, tie-in image left edge at TIEIN_LEFT_EDGE_X
+    img_stim_layout = {
+        'focal': dict(pos=(FOCAL_RIGHT_EDGE_X, IMAGE_CENTER_Y), anchor='right'),
+        'tiein': dict(pos=(TIEIN_LEFT_EDGE_X, IMAGE_CENTER_Y), anchor='left'),
+    }
     
     # Price text stimuli - all in red (positions will be calculated dynamically)
     focal_price_text = visual.TextStim(win, text='', height=PRICE_TEXT_HEIGHT, color=PRICE_COLOR,
@@ -612,43 +833,76 @@ def main():
     trials = build_trials()
     total_trials = len(trials)
     
+    # Precompute empty-screen jitters from a dedicated, seeded RNG
+    isi_seed = ISI_SEED if ISI_SEED is not None else random.randrange(2**32)
+    isi_rng = random.Random(isi_seed)
+    isi_jitters = [isi_rng.uniform(*EMPTY_SCREEN_INTERVAL) for _ in range(total_trials)]
+    isi_frames = [frames_for(d, refresh_hz) for d in isi_jitters]
+    logging.info(f"ISI seed: {isi_seed}")
+    
     # Preload/create placeholder images for bundles without actual images
-    placeholder_cache = {}
+    # (rendered in parallel, one per missing product)
+    placeholder_texts = {}
     for trial in trials:
-        if trial['focal_img_path'] is None:
-            cache_key = f"focal_{trial['bundle_id']}"
-            if cache_key not in placeholder_cache:
-                placeholder_cache[cache_key] = create_placeholder_image(
-                    IMAGE_MAX_SIZE[0], IMAGE_MAX_SIZE[1], 
-                    f"[{trial['focal_name'][:15]}]"
-                )
-            trial['focal_img_path'] = placeholder_cache[cache_key]
-        
-        if trial['tiein_img_path'] is None:
-            cache_key = f"tiein_{trial['bundle_id']}"
-            if cache_key not in placeholder_cache:
-                placeholder_cache[cache_key] = create_placeholder_image(
-                    IMAGE_MAX_SIZE[0], IMAGE_MAX_SIZE[1], 
-                    f"[{trial['tiein_name'][:15]}]"
+        for key in ('focal', 'tiein'):
+            if trial[f'{key}_img_path'] is None:
+                placeholder_texts[f"{key}_{trial['bundle_id']}"] = f"[{trial[f'{key}_name'][:15]}]"
+    # Products whose names share the first 15 characters get the same label,
+    # so each distinct label is rendered only once
+    unique_texts = list(dict.fromkeys(placeholder_texts.values()))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        text_paths = dict(zip(
+            unique_texts,
+            ex.map(lambda text: create_placeholder_image(IMAGE_MAX_SIZE[0], IMAGE_MAX_SIZE[1], text),
+                   unique_texts)
+        ))
+    placeholder_cache = {key: text_paths[text] for key, text in placeholder_texts.items()}
+    for trial in trials:
+        for key in ('focal', 'tiein'):
+            if trial[f'{key}_img_path'] is None:
+                trial[f'{key}_img_path'] = placeholder_cache[f"{key}_{trial['bundle_id']}"]
+    
+    # Decode every product image once and upload it into its own ImageStim
+    # (one texture per image), so trials only swap stimulus references.
+    # Image pairs are fixed per bundle, so the layout is computed once per bundle.
+    bundle_layouts = {}
+    for trial in trials:
+        bundle_id = trial['bundle_id']
+        if bundle_id not in bundle_layouts:
+            layout = {}
+            for key in ('focal', 'tiein'):
+                size = fitted_size_for_image(trial[f'{key}_img_path'], IMAGE_MAX_SIZE)
+                layout[f'{key}_stim'] = visual.ImageStim(
+                    win, image=load_fitted_image(trial[f'{key}_img_path'], IMAGE_MAX_SIZE),
+                    size=size, **img_stim_layout[key]
                 )
-            trial['tiein_img_path'] = placeholder_cache[cache_key]
+                layout[f'{key}_size'] = size
+            layout['focal_price_pos'], layout['tiein_price_pos'] = price_positions(
+                layout['focal_size'], layout['tiein_size']
+            )
+            bundle_layouts[bundle_id] = layout
+        trial.update(bundle_layouts[bundle_id])
     
     # Show instructions
     instructions.draw()
     win.flip()
     kb.clearEvents()
-    event.clearEvents()
-    kb.waitKeys(keyList=['space', 'escape'])
-    if any(k.name == 'escape' for k in kb.getKeys(waitRelease=False)):
+    keys = kb.waitKeys(keyList=['space', 'escape'], waitRelease=False)
+    if any(k.name == 'escape' for k in keys):
+        flush_markers()
         win.close()
         core.quit()
     
     # Create CSV with selected bundle info
-    create_csv_header(selected_bundle_id)
+    csv_rows, stop_csv_writer = start_csv_writer(create_csv_header(selected_bundle_id, isi_seed))
     
     # Initialize tracking variables
     bundles_bought = 0
     
+    # Row timestamps are a single wall-clock anchor plus monotonic elapsed time
+    wall_anchor = datetime.now()
+    mono_anchor = core.getTime()
+    
     # Trial loop
     for t_idx, trial in enumerate(trials):
         current_block = (t_idx // TRIALS_PER_BLOCK) + 1
@@ -656,111 +910,52 @@ def main():
         
         # Clear events before trial
         kb.clearEvents()
-        event.clearEvents()
         
         # =====================================================================
         # PHASE 1: Fixation (1000 ms)
         # =====================================================================
         send_marker(win, MARKER_FIXATION)
-        fix_onset = core.getTime()
-        while (core.getTime() - fix_onset) < FIXATION_TIME:
-            fixation.draw()
-            win.flip()
-            if kb.getKeys(keyList=['escape'], waitRelease=False):
-                win.close()
-                core.quit()
+        hold_static(win, kb, [fixation], n_frames_fixation, refresh_hz)
         
         # =====================================================================
         # PHASE 2: Bundle Preview - images only, no prices (2000 ms)
         # =====================================================================
-        # Load images for this trial
-        focal_img_stim.image = trial['focal_img_path']
-        focal_size = fitted_size_for_image(trial['focal_img_path'], IMAGE_MAX_SIZE)
-        focal_img_stim.size = focal_size
-        
-        tiein_img_stim.image = trial['tiein_img_path']
-        tiein_size = fitted_size_for_image(trial['tiein_img_path'], IMAGE_MAX_SIZE)
-        tiein_img_stim.size = tiein_size
-        
-        # Calculate positions: focal image right edge at FOCAL_RIGHT_EDGE_X, tiein image left edge at TIEIN_LEFT_EDGE_X
-        # For anchor='right', pos.x is the right edge position
-        # For anchor='left', pos.x is the left edge position
-        focal_img_stim.pos = (FOCAL_RIGHT_EDGE_X, IMAGE_CENTER_Y)
-        tiein_img_stim.pos = (TIEIN_LEFT_EDGE_X, IMAGE_CENTER_Y)
-        
-        # Calculate price positions: below the lowest image bottom
-        # Image bottom = center_y - height/2 (in pixels, but PsychoPy uses normalized units)
-        # We need to convert pixel sizes to normalized units
-        # Assuming win.size gives window size in pixels
-        win_w, win_h = win.size
-        focal_h_pixels = focal_size[1]
-        tiein_h_pixels = tiein_size[1]
-        
-        # Convert pixel heights to normalized units (PsychoPy uses height units by default)
-        # For 'pix' units, we can use pixel values directly
-        focal_bottom_y = IMAGE_CENTER_Y - (focal_h_pixels / 2.0)
-        tiein_bottom_y = IMAGE_CENTER_Y - (tiein_h_pixels / 2.0)
-        lowest_bottom_y = min(focal_bottom_y, tiein_bottom_y)
-        
-        # Price Y position: lowest image bottom - offset
-        price_y = lowest_bottom_y - PRICE_OFFSET_BELOW_IMAGE
-        
-        # Price X positions: aligned with image centers
-        focal_center_x = FOCAL_RIGHT_EDGE_X - (focal_size[0] / 2.0)
-        tiein_center_x = TIEIN_LEFT_EDGE_X + (tiein_size[0] / 2.0)
-        
-        focal_price_text.pos = (focal_center_x, price_y)
-        tiein_price_text.pos = (tiein_center_x, price_y)
+        # Preloaded image stimuli for this trial (price positions precomputed)
+        focal_img_stim = trial['focal_stim']
+        tiein_img_stim = trial['tiein_stim']
+        focal_price_text.pos = trial['focal_price_pos']
+        tiein_price_text.pos = trial['tiein_price_pos']
         
         send_marker(win, MARKER_BUNDLE_PREVIEW)
-        preview_onset = core.getTime()
-        while (core.getTime() - preview_onset) < BUNDLE_PREVIEW_TIME:
-            focal_img_stim.draw()
-            tiein_img_stim.draw()
-            fixation.draw()
-            win.flip()
-            if kb.getKeys(keyList=['escape'], waitRelease=False):
-                win.close()
-                core.quit()
+        hold_static(win, kb, [focal_img_stim, tiein_img_stim, fixation], n_frames_preview, refresh_hz)
         
         # =====================================================================
         # PHASE 3: Empty Screen (400-600 ms randomized)
         # =====================================================================
-        empty_duration = random.uniform(*EMPTY_SCREEN_INTERVAL)
-        empty_onset = core.getTime()
-        while (core.getTime() - empty_onset) < empty_duration:
-            win.flip()
-            if kb.getKeys(keyList=['escape'], waitRelease=False):
-                win.close()
-                core.quit()
+        flush_markers()
+        hold_static(win, kb, [], isi_frames[t_idx], refresh_hz)
         
         # =====================================================================
         # PHASE 4: Bundle with Prices - Response Window (4000 ms)
         # =====================================================================
         # Set price texts - all in red
         # (Positions already calculated in PHASE 2 based on image sizes)
-        focal_price_text.text = format_price(trial['focal_price'])
-        tiein_price_text.text = format_price(trial['tiein_price'])
+        focal_price_text.text = trial['focal_price_str']
+        tiein_price_text.text = trial['tiein_price_str']
         # Total price not displayed (only individual product prices shown)
         
         # Send condition-specific marker
-        if trial['condition'] == 'NP':
-            send_marker(win, MARKER_BUNDLE_PRICE_NP)
-        elif trial['condition'] == 'LP':
-            send_marker(win, MARKER_BUNDLE_PRICE_LP)
-        elif trial['condition'] == 'ZP':
-            send_marker(win, MARKER_BUNDLE_PRICE_ZP)
+        send_marker(win, MARKER_BY_CONDITION[trial['condition']])
         
-        kb.clearEvents()
-        event.clearEvents()
-        price_onset = core.getTime()
-        response_deadline = price_onset + PRICE_RESPONSE_TIME
+        # Reset the keyboard clock on the price-onset flip so k.rt is the RT from price onset
+        win.callOnFlip(kb.clearEvents)
+        win.callOnFlip(kb.clock.reset)
         
         resp_key = None
         rt_ms = None
         response = None
         
-        while core.getTime() < response_deadline:
+        for _ in range(n_frames_price):
             # Draw stimuli - images + prices
             focal_img_stim.draw()
             tiein_img_stim.draw()
@@ -774,19 +969,16 @@ def main():
             if keys:
                 k = keys[0]
                 if k.name == 'escape':
+                    flush_markers()
                     win.close()
                     core.quit()
                 if resp_key is None:
                     resp_key = k.name
-                    rt_ms = (k.tDown - price_onset) * 1000  # RT from price onset
+                    rt_ms = k.rt * 1000  # RT from price onset
                     
                     # Determine response type
-                    if resp_key in buy_keys:
-                        response = 'BUY'
-                        send_marker(win, MARKER_RESPONSE_BUY)
-                    else:
-                        response = 'NOBUY'
-                        send_marker(win, MARKER_RESPONSE_NOBUY)
+                    response = 'BUY' if resp_key in buy_keys else 'NOBUY'
+                    send_marker(win, MARKER_BY_RESPONSE[response])
         
         # If no response, send marker
         if resp_key is None:
@@ -795,41 +987,37 @@ def main():
         # =====================================================================
         # Update tracking
         # =====================================================================
-        valid_response = 1 if (rt_ms is not None and rt_ms < 4000) else 0
-        
-        if response == 'BUY' and valid_response:
-            bundles_bought += 1
-            # Check if this is the selected bundle
-            if is_selected:
-                selected_bundle_bought = True
+        valid_response, bundles_bought, bought_selected = update_trial_state(
+            bundles_bought, response, rt_ms, is_selected
+        )
+        if bought_selected:
+            selected_bundle_bought = True
         
         # =====================================================================
         # Log trial to CSV
         # =====================================================================
-        with open(OUT_CSV, "a", newline="", encoding="utf-8") as fh:
-            w = csv.writer(fh)
-            w.writerow([
-                datetime.now().isoformat(timespec='milliseconds'),
-                participant_id,
-                age,
-                response_group,
-                t_idx,
-                current_block,
-                trial['bundle_id'],
-                trial['focal_name'],
-                trial['tiein_name'],
-                trial['condition'],
-                trial['focal_price'],
-                trial['tiein_price'],
-                trial['total_price'],
-                ALLOCATION_PER_TRIAL,
-                resp_key or '',
-                response or '',
-                round(rt_ms, 2) if rt_ms is not None else '',
-                valid_response,
-                is_selected,
-                bundles_bought,
-            ])
+        csv_rows.put([
+            (wall_anchor + timedelta(seconds=core.getTime() - mono_anchor)).isoformat(timespec='milliseconds'),
+            participant_id,
+            age,
+            response_group,
+            t_idx,
+            current_block,
+            trial['bundle_id'],
+            trial['focal_name'],
+            trial['tiein_name'],
+            trial['condition'],
+            trial['focal_price'],
+            trial['tiein_price'],
+            trial['total_price'],
+            ALLOCATION_PER_TRIAL,
+            resp_key or '',
+            response or '',
+            round(rt_ms, 2) if rt_ms is not None else '',
+            valid_response,
+            is_selected,
+            bundles_bought,
+        ])
         
         # =====================================================================
         # Block rest screen
@@ -845,21 +1033,15 @@ def main():
                 f"Press SPACE to continue."
             )
             
+            rest_text.draw()
+            win.flip()
+            kb.clearEvents()
+            keys = kb.waitKeys(keyList=['space', 'escape'], waitRelease=False)
+            if any(k.name == 'escape' for k in keys):
+                flush_markers()
+                win.close()
+                core.quit()
             kb.clearEvents()
-            event.clearEvents()
-            while True:
-                rest_text.draw()
-                win.flip()
-                keys = kb.getKeys(keyList=['space', 'escape'], waitRelease=False)
-                if keys:
-                    if any(k.name == 'escape' for k in keys):
-                        win.close()
-                        core.quit()
-                    if any(k.name == 'space' for k in keys):
-                        kb.clearEvents()
-                        event.clearEvents()
-                        break
-                core.wait(0.01)
     
     # =========================================================================
     # End of experiment - calculate final results
@@ -894,34 +1076,22 @@ def main():
     
     end_text.draw()
     win.flip()
+    flush_markers()
     
     # Log summary to CSV
-    with open(OUT_CSV, "a", newline="", encoding="utf-8") as fh:
-        w = csv.writer(fh)
-        w.writerow([])
-        w.writerow(["# SUMMARY"])
-        w.writerow(["# Bundles bought", bundles_bought])
-        w.writerow(["# Penalty", round(penalty, 2)])
-        w.writerow(["# Selected bundle ID", selected_bundle_id])
-        w.writerow(["# Selected bundle name", selected_bundle_name])
-        w.writerow(["# Selected bundle bought", selected_bundle_bought])
+    csv_rows.put([])
+    csv_rows.put(["# SUMMARY"])
+    csv_rows.put(["# Bundles bought", bundles_bought])
+    csv_rows.put(["# Penalty", round(penalty, 2)])
+    csv_rows.put(["# Selected bundle ID", selected_bundle_id])
+    csv_rows.put(["# Selected bundle name", selected_bundle_name])
+    csv_rows.put(["# Selected bundle bought", selected_bundle_bought])
+    stop_csv_writer()
     
     kb.clearEvents()
-    while True:
-        keys = kb.getKeys(waitRelease=False)
-        if any(k.name in ('return', 'enter', 'escape') for k in keys):
-            break
-        core.wait(0.01)
-    
-    # Clean up placeholder images
-    temp_dir = os.path.join(BASE_DIR, "temp_images")
-    if os.path.exists(temp_dir):
-        import shutil
-        try:
-            shutil.rmtree(temp_dir)
-        except:
-            pass
+    kb.waitKeys(keyList=['return', 'enter', 'escape'], waitRelease=False)
     
+    core.rush(False)
     win.close()
     core.quit()
 
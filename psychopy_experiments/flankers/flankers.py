@@ -7,7 +7,8 @@ Respond to CENTER arrow: '<' = Left Shift, '>' = Right Shift
 from psychopy import visual, core, event, logging
 from psychopy.hardware import keyboard
 import numpy as np
-import random, os, csv
+import os
+from collections import namedtuple
 from datetime import datetime
 from pylsl import StreamInfo, StreamOutlet
 
@@ -37,6 +38,13 @@ info = StreamInfo(name='PsychopyMarkerStream', type='Markers',
 outlet = StreamOutlet(info)
 MARKER_STIM_ONSET = 1
 MARKER_RESP = 2
+
+# -------------------- CSV --------------------
+# Arrow strings and key names never need quoting: format rows directly
+CSV_HEADER = ("t_onset_s,global_trial,block,trial_in_block,"
+              "stimulus,center_dir,congruent,correct_key,"
+              "resp_key,correct,rt_ms,stim_time_s,isi_s\n")
+ROW_FMT = "{ts:.3f},{gt},{blk},{tib},{stim},{cd},{cong},{ck},{rk},{cor},{rt},{stt},{isi:.3f}\n"
 # -------------------- Utilities --------------------
 logging.console.setLevel(logging.INFO)
 
@@ -53,61 +61,48 @@ def write_text(win, text, pos=(0,0), height=0.045, wrap=1.6, bold=False):
 def draw_fixation(win, size=0.06, color='black'):
     return visual.TextStim(win, text='+', height=size, color=color, bold=True, units='height')
 
+# Stimulus table: index -> arrow string, center direction (0 '<', 1 '>'), congruency
+STIM_STRS      = ('<<<<<', '>>>>>', '>><>>', '<<><<')
+STIM_CENTER    = np.array([0, 1, 0, 1], dtype=np.int8)
+STIM_CONGRUENT = np.array([1, 1, 0, 0], dtype=np.int8)
+CENTER_CHARS   = ('<', '>')
+RESP_KEYS      = ('lshift', 'slash')   # indexed by center direction
+
+TrialBlock = namedtuple('TrialBlock', 'stim_idx correct_key_idx congruent center_dir')
+
 def gen_block_trials(block_size):
     """
     Generate block_size trials with:
       - 50% congruent (all flankers match center), 50% incongruent (flankers opposite center)
       - 50% center '<', 50% center '>'
-    Return list of dicts: {'stim_str','center','congruent','correct_key'}
+    Return a TrialBlock of int8 arrays (one entry per trial, already shuffled):
+      stim_idx -> STIM_STRS, correct_key_idx -> RESP_KEYS,
+      congruent (0/1), center_dir -> CENTER_CHARS
     """
     # counts
     n_cong = block_size // 2
     n_incong = block_size - n_cong
-    # split directions evenly within each congruency
-    n_cong_left = n_cong // 2
-    n_cong_right = n_cong - n_cong_left
-    n_incong_left = n_incong // 2
-    n_incong_right = n_incong - n_incong_left
-
-    trials = []
-
-    # helper to build 5-char string given center and congruency
-    def build(center, congruent):
-        flank = center if congruent else ('<' if center == '>' else '>')
-        return flank*2 + center + flank*2
-
-    # congruent-left
-    for _ in range(n_cong_left):
-        c = '<'
-        s = build(c, True)
-        trials.append(dict(stim_str=s, center=c, congruent=True, correct_key='lshift'))
-    # congruent-right
-    for _ in range(n_cong_right):
-        c = '>'
-        s = build(c, True)
-        trials.append(dict(stim_str=s, center=c, congruent=True, correct_key='slash'))
-    # incongruent-left (center '<', flankers '>')
-    for _ in range(n_incong_left):
-        c = '<'
-        s = build(c, False)
-        trials.append(dict(stim_str=s, center=c, congruent=False, correct_key='lshift'))
-    # incongruent-right (center '>', flankers '<')
-    for _ in range(n_incong_right):
-        c = '>'
-        s = build(c, False)
-        trials.append(dict(stim_str=s, center=c, congruent=False, correct_key='slash'))
-
-    random.shuffle(trials)
-    return trials
+    # split directions evenly within each congruency, in STIM_STRS order
+    counts = (n_cong // 2, n_cong - n_cong // 2, n_incong // 2, n_incong - n_incong // 2)
+
+    stim_idx = np.repeat(np.arange(len(STIM_STRS), dtype=np.int8), counts)
+    stim_idx = stim_idx[np.random.permutation(block_size)]
+    center = STIM_CENTER[stim_idx]
+    return TrialBlock(stim_idx=stim_idx, correct_key_idx=center,
+                      congruent=STIM_CONGRUENT[stim_idx], center_dir=center)
 
 # -------------------- Main --------------------
 def main():
     win = visual.Window(size=win_size, units='pix', color=bg_color, fullscr=fullscr)
-    kb = keyboard.Keyboard()
+    kb = keyboard.Keyboard(backend='ptb')
     fixation = draw_fixation(win)
 
-    # Stimulus object — monospaced feel, big and clean
-    stim = visual.TextStim(win, text='', height=64, color='black', font='Courier New')
+    # Stimulus objects — monospaced feel, big and clean; one per distinct arrow string
+    # so the text is laid out once here instead of on every trial
+    stims = [
+        visual.TextStim(win, text=s, height=64, color='black', font='Courier New')
+        for s in STIM_STRS
+    ]
 
     # Instructions
     instr = write_text(
@@ -123,165 +118,177 @@ def main():
     kb.clearEvents(); event.clearEvents()
     kb.waitKeys(keyList=['space'])
 
-    # CSV header
+    # CSV: kept open for the whole session, flushed at the end of each block
     with open(OUT_CSV, "w", newline="", encoding="utf-8") as fh:
-        w = csv.writer(fh)
-        w.writerow([
-            "timestamp_iso","global_trial","block","trial_in_block",
-            "stimulus","center_dir","congruent","correct_key",
-            "resp_key","correct","rt_ms","stim_time_s","isi_s"
-        ])
-
-    total_trials = 0
-    cum_errors  = 0
-    block_idx   = 0
-
-    # Loop blocks until stop conditions satisfied
-    while True:
-        block_idx += 1
-        trials = gen_block_trials(BLOCK_SIZE)
-        block_errors = 0
-
-        # Block loop
-        for t_idx, t in enumerate(trials, start=1):
-            # --- Fixation during ISI, collect responses during ISI window (carryover) ---
-            isi = random.uniform(ISI_INTERVAL[0], ISI_INTERVAL[1])
-            t0 = core.getTime()
-            kb.clearEvents(); event.clearEvents()
-
-            # Draw fixation during ISI while we *allow* late responses from previous trial to be ignored (kb cleared above)
-            while (core.getTime() - t0) < isi:
-                fixation.draw()
+        # Rows carry stimulus onset in seconds since this anchor (monotonic clock)
+        session_t0 = core.getTime()
+        fh.write(f"# SESSION_START_ISO,{datetime.now().isoformat(timespec='milliseconds')}\n\n")
+        fh.write(CSV_HEADER)
+
+        total_trials = 0
+        cum_errors  = 0
+        block_idx   = 0
+
+        # Loop blocks until stop conditions satisfied
+        while True:
+            block_idx += 1
+            block = gen_block_trials(BLOCK_SIZE)
+            # Both ISIs for the whole block, drawn up front (off the pre-flip path)
+            isis      = np.random.uniform(ISI_INTERVAL[0], ISI_INTERVAL[1], size=BLOCK_SIZE)
+            post_isis = np.random.uniform(ISI_INTERVAL[0], ISI_INTERVAL[1], size=BLOCK_SIZE)
+            block_errors = 0
+            # Fixation is redrawn by the window on every flip through the trials;
+            # only the stimulus flip turns it off
+            fixation.autoDraw = True
+
+            # Block loop
+            for i in range(BLOCK_SIZE):
+                t_idx = i + 1
+                stim_i = block.stim_idx[i]
+                correct_key = RESP_KEYS[block.correct_key_idx[i]]
+                # --- Fixation during ISI, collect responses during ISI window (carryover) ---
+                isi = float(isis[i])
+                t0 = core.getTime()
+                kb.clearEvents(); event.clearEvents()
+
+                # Fixation is static (autoDraw, see below): one flip, then sit out the ISI
+                # (kb cleared above, so late responses are ignored)
                 win.flip()
+                core.wait(isi - (core.getTime() - t0), hogCPUperiod=0.002)
 
-            # --- Stimulus onset ---
-            stim.text = t['stim_str']
-            stim.draw()
-            send_marker(win, MARKER_STIM_ONSET)
-            win.flip()
-            stim_on = core.getTime()
-
-            # Accept response from stim onset through the *next* ISI (i.e., a unified response window: STIM_TIME + ISI)
-            rt = None
-            resp_key = None
-            correct = 0
-
-            # Keep stim visible for STIM_TIME
-            kb.clearEvents()
-            while (core.getTime() - stim_on) < STIM_TIME:
-                # check keys without blocking
-                keys = kb.getKeys(keyList=['lshift','slash','leftshift','escape'], waitRelease=False)
-                if keys:
-                    k = keys[0].name
-                    if k == 'escape':
-                        win.close(); core.quit()
-                    # normalize aliases
-                    if k == 'leftshift':  k = 'lshift'
-                    # if k == 'slash': k = 'slash'
-                    if k in ('lshift','slash') and resp_key is None:
-                        send_marker(win, MARKER_RESP)
-                        resp_key = k
-                        rt = (keys[0].rt) * 1000.0  # ms
-                # keep showing stim
+                # --- Stimulus onset ---
+                stim = stims[stim_i]
+                fixation.autoDraw = False
                 stim.draw()
+                send_marker(win, MARKER_STIM_ONSET)
+                # Zero the keyboard clock on the onset flip so key.rt is the RT from stim onset
+                win.callOnFlip(kb.clearEvents)
+                win.callOnFlip(kb.clock.reset)
                 win.flip()
+                stim_on = core.getTime()
 
-            # Turn off stim, go to post-stim ISI (still accept response if none yet)
-            post_isi = random.uniform(ISI_INTERVAL[0], ISI_INTERVAL[1])
-            post_start = core.getTime()
-            while (core.getTime() - post_start) < post_isi and resp_key is None:
-                fixation.draw()
-                win.flip()
-                keys = kb.getKeys(keyList=['lshift','slash','leftshift','escape'], waitRelease=False)
-                if keys:
-                    k = keys[0].name
-                    if k == 'escape':
-                        win.close(); core.quit()
-                    if k == 'leftshift':  k = 'lshift'
-                    # if k == 'rightshift': k = 'rshift'
-                    if k in ('lshift','slash'):
-                        send_marker(win, MARKER_RESP)
-                        resp_key = k
-                        # RT from stim onset
-                        rt = (core.getTime() - stim_on) * 1000.0
-
-            # Score
-            if resp_key is None:
+                # Accept response from stim onset through the *next* ISI (i.e., a unified response window: STIM_TIME + ISI)
+                rt = None
+                resp_key = None
                 correct = 0
-                block_errors += 1
-                cum_errors  += 1
-            else:
-                correct = int(resp_key == t['correct_key'])
-                if not correct:
+
+                # Stim is static: leave the onset frame up for STIM_TIME, only draining key events
+                while (core.getTime() - stim_on) < STIM_TIME:
+                    # check keys without blocking
+                    keys = kb.getKeys(keyList=['lshift','slash','leftshift','escape'], waitRelease=False)
+                    if keys:
+                        k = keys[0].name
+                        if k == 'escape':
+                            win.close(); core.quit()
+                        # normalize aliases
+                        if k == 'leftshift':  k = 'lshift'
+                        # if k == 'slash': k = 'slash'
+                        if k in ('lshift','slash') and resp_key is None:
+                            outlet.push_sample([MARKER_RESP])  # no flip pending, push now
+                            resp_key = k
+                            rt = (keys[0].rt) * 1000.0  # ms
+                    core.wait(0.001, hogCPUperiod=0)
+
+                # Turn off stim, go to post-stim ISI (still accept response if none yet)
+                post_isi = float(post_isis[i])
+                post_start = core.getTime()
+                fixation.autoDraw = True
+                win.flip()
+                while (core.getTime() - post_start) < post_isi and resp_key is None:
+                    core.wait(0.001, hogCPUperiod=0)
+                    keys = kb.getKeys(keyList=['lshift','slash','leftshift','escape'], waitRelease=False)
+                    if keys:
+                        k = keys[0].name
+                        if k == 'escape':
+                            win.close(); core.quit()
+                        if k == 'leftshift':  k = 'lshift'
+                        # if k == 'rightshift': k = 'rshift'
+                        if k in ('lshift','slash'):
+                            outlet.push_sample([MARKER_RESP])  # no flip pending, push now
+                            resp_key = k
+                            # RT from stim onset (keyboard clock was reset on the onset flip)
+                            rt = (keys[0].rt) * 1000.0
+
+                # Score
+                if resp_key is None:
+                    correct = 0
                     block_errors += 1
                     cum_errors  += 1
+                else:
+                    correct = int(resp_key == correct_key)
+                    if not correct:
+                        block_errors += 1
+                        cum_errors  += 1
+
+                total_trials += 1
+
+                # Log
+                fh.write(ROW_FMT.format(
+                    ts=stim_on - session_t0,
+                    gt=total_trials, blk=block_idx, tib=t_idx,
+                    stim=STIM_STRS[stim_i], cd=CENTER_CHARS[block.center_dir[i]],
+                    cong=int(block.congruent[i]), ck=correct_key,
+                    rk=resp_key if resp_key else '', cor=int(correct),
+                    rt=f"{rt:.2f}" if rt else '',
+                    stt=STIM_TIME, isi=post_isi
+                ))
+
+                # Esc quick-quit
+                for k in kb.getKeys(waitRelease=False):
+                    if k.name == 'escape':
+                        win.close(); core.quit()
 
-            total_trials += 1
-
-            # Log
-            with open(OUT_CSV, "a", newline="", encoding="utf-8") as fh:
-                w = csv.writer(fh)
-                w.writerow([
-                    datetime.now().isoformat(timespec='milliseconds'),
-                    total_trials, block_idx, t_idx,
-                    t['stim_str'], t['center'], int(t['congruent']), t['correct_key'],
-                    resp_key if resp_key else '', int(correct), round(rt,2) if rt else '',
-                    STIM_TIME, round(post_isi,3)
-                ])
-
-            # Esc quick-quit
-            for k in kb.getKeys(waitRelease=False):
-                if k.name == 'escape':
-                    win.close(); core.quit()
-
-        # ----- Block end feedback -----
-        block_err_rate = block_errors / float(BLOCK_SIZE)
-        if block_err_rate > ERR_RATE_MAX:
-            msg = "Too many errors (>20%). SLOW DOWN a bit next block."
-        elif block_err_rate < ERR_RATE_MIN:
-            msg = "Very low errors (<10%). You can SPEED UP a bit next block."
-        else:
-            msg = "Nice pacing. Keep it steady."
-
-        fb = write_text(
-            win,
-            f"Block {block_idx} complete.\n\n"
-            f"Errors this block: {block_errors}/{BLOCK_SIZE} ({block_err_rate*100:.1f}%)\n\n"
-            f"{msg}\n\nPress SPACE to continue.",
-            height=0.05
-        )
-        fb.draw(); win.flip()
-        kb.clearEvents(); event.clearEvents()
-        kb.waitKeys(keyList=['space','escape'])
-        if any(k.name == 'escape' for k in kb.getKeys(waitRelease=False)):
-            win.close(); core.quit()
-
-        # ----- Early stop logic -----
-        # If we've reached the minimum trials AND cumulative errors have reached the threshold, stop.
-        if (total_trials >= N_TRIALS_MIN) and (cum_errors >= MIN_ERR_COUNT):
-            end = write_text(
-                win,
-                f"Stopping early: criteria met.\n\n"
-                f"Total trials: {total_trials}\nCumulative errors: {cum_errors}\n\n"
-                f"Data saved to:\n{os.path.basename(OUT_CSV)}\n\nPress ENTER to exit.",
-                height=0.05
-            )
-            end.draw(); win.flip()
-            _wait_exit(kb, win)
-            return
+            fixation.autoDraw = False
+            fh.flush()
 
-        # If we hit the max trial cap, stop regardless.
-        if total_trials >= N_TRIALS_MAX:
-            end = write_text(
+            # ----- Block end feedback -----
+            block_err_rate = block_errors / float(BLOCK_SIZE)
+            if block_err_rate > ERR_RATE_MAX:
+                msg = "Too many errors (>20%). SLOW DOWN a bit next block."
+            elif block_err_rate < ERR_RATE_MIN:
+                msg = "Very low errors (<10%). You can SPEED UP a bit next block."
+            else:
+                msg = "Nice pacing. Keep it steady."
+
+            fb = write_text(
                 win,
-                f"Reached maximum trials.\n\n"
-                f"Total trials: {total_trials}\nCumulative errors: {cum_errors}\n\n"
-                f"Data saved to:\n{os.path.basename(OUT_CSV)}\n\nPress ENTER to exit.",
+                f"Block {block_idx} complete.\n\n"
+                f"Errors this block: {block_errors}/{BLOCK_SIZE} ({block_err_rate*100:.1f}%)\n\n"
+                f"{msg}\n\nPress SPACE to continue.",
                 height=0.05
             )
-            end.draw(); win.flip()
-            _wait_exit(kb, win)
-            return
+            fb.draw(); win.flip()
+            kb.clearEvents(); event.clearEvents()
+            kb.waitKeys(keyList=['space','escape'])
+            if any(k.name == 'escape' for k in kb.getKeys(waitRelease=False)):
+                win.close(); core.quit()
+
+            # ----- Early stop logic -----
+            # If we've reached the minimum trials AND cumulative errors have reached the threshold, stop.
+            if (total_trials >= N_TRIALS_MIN) and (cum_errors >= MIN_ERR_COUNT):
+                end = write_text(
+                    win,
+                    f"Stopping early: criteria met.\n\n"
+                    f"Total trials: {total_trials}\nCumulative errors: {cum_errors}\n\n"
+                    f"Data saved to:\n{os.path.basename(OUT_CSV)}\n\nPress ENTER to exit.",
+                    height=0.05
+                )
+                end.draw(); win.flip()
+                _wait_exit(kb, win)
+                return
+
+            # If we hit the max trial cap, stop regardless.
+            if total_trials >= N_TRIALS_MAX:
+                end = write_text(
+                    win,
+                    f"Reached maximum trials.\n\n"
+                    f"Total trials: {total_trials}\nCumulative errors: {cum_errors}\n\n"
+                    f"Data saved to:\n{os.path.basename(OUT_CSV)}\n\nPress ENTER to exit.",
+                    height=0.05
+                )
+                end.draw(); win.flip()
+                _wait_exit(kb, win)
+                return
 
 def _wait_exit(kb, win):
     kb.clearEvents()
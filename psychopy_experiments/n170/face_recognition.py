@@ -9,8 +9,9 @@ from psychopy import visual, core, event, logging
 from psychopy.hardware import keyboard
 from pylsl import StreamInfo, StreamOutlet
 from PIL import Image
-import os, glob, csv, random
+import os, glob, random, pickle, functools
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------- PARAMETERS --------------------
 TITLE = "N170 (Faces vs Cars; Intact vs Scrambled)"
@@ -27,6 +28,7 @@ KEY_SCRAMBLED = 'left'       # LEFT arrow  = scrambled (scrambled faces/cars)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MEDIA_DIR = os.path.join(BASE_DIR, 'media')
+SIZES_CACHE = os.path.join(MEDIA_DIR, '.sizes.pkl')
 OUT_CSV = os.path.join(BASE_DIR, f"n170_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
 
 # Event codes (ERP CORE)
@@ -37,6 +39,14 @@ CODES_SC_START   = 141        # 141–180
 RESP_CORRECT = 201
 RESP_INCORRECT = 202
 
+# CSV rows are numeric or plain file names (no commas/quotes), so they are
+# written from a fixed template instead of going through csv.writer
+CSV_HEADER = ("t_onset_s,trial_index,image_file,class,scrambled,"
+              "marker_code,resp_key,correct,rt_ms,stim_time_s,isi_s,"
+              "shown_width_units,shown_height_units\n")
+ROW_FMT = ("{ts:.3f},{idx},{img},{cls},{scr},{code},{rk},{cor},{rt},{stt},{isi:.3f},"
+           "{w:.4f},{h:.4f}\n")
+
 # -------------------- LSL --------------------
 info = StreamInfo(name='PsychopyMarkerStream', type='Markers',
                   channel_count=1, channel_format='int32',
@@ -62,11 +72,46 @@ def show_text_and_wait(win, text, wait_keys=('space',), pos=(0, 0.0), height=0.0
 def send_marker_on_flip(win, value):
     win.callOnFlip(outlet.push_sample, [int(value)])
 
+@functools.lru_cache(maxsize=None)
 def image_native_size(path):
     """Return (width_px, height_px) using Pillow, for aspect ratio."""
     with Image.open(path) as im:
         return im.size  # (w, h) in pixels
 
+def load_native_sizes(paths, cache_path=SIZES_CACHE):
+    """
+    Return {path: (width_px, height_px)} for all paths.
+    Sizes are pickled to 'cache_path' together with each file's mtime;
+    only files that are new or modified since the last run are opened.
+    """
+    try:
+        with open(cache_path, "rb") as fh:
+            cache = pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        cache = {}
+
+    sizes, dirty = {}, False
+    for p in paths:
+        name, mtime = os.path.basename(p), os.path.getmtime(p)
+        hit = cache.get(name)
+        if hit is None or hit[0] != mtime:
+            hit = cache[name] = (mtime, image_native_size(p))
+            dirty = True
+        sizes[p] = hit[1]
+
+    if dirty:
+        try:
+            with open(cache_path, "wb") as fh:
+                pickle.dump(cache, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logging.warning(f"Could not write size cache {cache_path}: {e}")
+    return sizes
+
+def decode_image(path):
+    """Fully decode a JPEG to an RGB PIL image (libjpeg releases the GIL)."""
+    with Image.open(path) as im:
+        return im.convert('RGB')
+
 def list_images():
     def sorted_glob(pattern):
         paths = glob.glob(os.path.join(MEDIA_DIR, pattern))
@@ -94,11 +139,12 @@ def build_trials(faces, cars, sfaces, scars):
             f"Need balanced sets in {MEDIA_DIR}: face_*, car_*, scrambled_face_*, scrambled_car_*"
         )
     faces, cars, sfaces, scars = faces[:n], cars[:n], sfaces[:n], scars[:n]
+    native = load_native_sizes(faces + cars + sfaces + scars)
 
     def make_entries(paths, cls, scrambled, code_start):
         entries = []
         for i, p in enumerate(paths):
-            wpx, hpx = image_native_size(p)
+            wpx, hpx = native[p]
             aspect = (wpx / float(hpx)) if hpx > 0 else 1.0
             size_units = (STIM_HEIGHT * aspect, STIM_HEIGHT)  # width, height in 'height' units
             entries.append(dict(
@@ -119,14 +165,16 @@ def build_trials(faces, cars, sfaces, scars):
 # -------------------- MAIN --------------------
 def main():
     win = visual.Window(size=WIN_SIZE, units=UNITS, color=BG_COLOR, fullscr=FULLSCR)
-    kb = keyboard.Keyboard()
+    kb = keyboard.Keyboard(backend='ptb')
     mouse = event.Mouse(visible=False, win=win)
 
     faces, cars, sfaces, scars = list_images()
     trials = build_trials(faces, cars, sfaces, scars)
 
-    # Reusable ImageStim; size will be set per-trial from precomputed aspect
-    img = visual.ImageStim(win, image=None, units=UNITS, interpolate=True, autoLog=False)
+    # Decode every JPEG on worker threads while the instructions are up; textures
+    # are uploaded (main thread, GL) once the participant presses SPACE
+    decoder = ThreadPoolExecutor()
+    decoded = {t['path']: decoder.submit(decode_image, t['path']) for t in trials}
 
     instr = (
         f"{TITLE}\n\n"
@@ -138,83 +186,96 @@ def main():
     )
     show_text_and_wait(win, instr, wait_keys=('space',))
 
-    # CSV header
+    # One ImageStim per image, built up front so decode and texture upload
+    # happen here rather than inside a timed trial
+    img_pool = {
+        t['path']: visual.ImageStim(win, image=decoded[t['path']].result(), size=t['size'],
+                                    units=UNITS, interpolate=True, autoLog=False)
+        for t in trials
+    }
+    decoder.shutdown()
+    del decoded
+
+    # CSV: kept open for the whole trial loop
     with open(OUT_CSV, "w", newline="", encoding="utf-8") as fh:
-        w = csv.writer(fh)
-        w.writerow([
-            "timestamp_iso", "trial_index", "image_file", "class", "scrambled",
-            "marker_code", "resp_key", "correct", "rt_ms", "stim_time_s", "isi_s",
-            "shown_width_units", "shown_height_units"
-        ])
-
-    # Trial loop
-    for t_idx, t in enumerate(trials, start=1):
-        kb.clearEvents(); event.clearEvents()
-        resp_key = None; rt_ms = None; correct = 0
-
-        # Set image and size (no squashing)
-        img.image = t['path']
-        img.size = t['size']  # (w,h) with fixed h and width scaled by native aspect
-
-        # Stimulus onset (marker on flip)
-        send_marker_on_flip(win, t['code'])
-        img.draw()
-        stim_on = core.getTime()
-        win.flip()
-
-        # Show for STIM_TIME; collect responses but don't shorten timing
-        while (core.getTime() - stim_on) < STIM_TIME:
-            keys = kb.getKeys(keyList=[KEY_INTACT, KEY_SCRAMBLED, 'escape'], waitRelease=False)
-            if keys and resp_key is None:
-                k = keys[0].name
-                if k == 'escape':
-                    win.close(); core.quit()
-                if k in (KEY_INTACT, KEY_SCRAMBLED):
-                    resp_key = k
-                    rt_ms = (core.getTime() - stim_on) * 1000.0
-
-        # Blank ISI (randomized)
-        isi = random.uniform(*ISI_RANGE)
-        isi_start = core.getTime()
-        while (core.getTime() - isi_start) < isi:
+        # Rows carry stimulus onset in seconds since this anchor (monotonic clock)
+        session_t0 = core.getTime()
+        fh.write(f"# SESSION_START_ISO,{datetime.now().isoformat(timespec='milliseconds')}\n\n")
+        fh.write(CSV_HEADER)
+
+        # All ISIs drawn up front (off the pre-flip path)
+        isis = [random.uniform(*ISI_RANGE) for _ in trials]
+
+        # Trial loop
+        for t_idx, t in enumerate(trials, start=1):
+            kb.clearEvents(); event.clearEvents()
+            resp_key = None; rt_ms = None; correct = 0
+
+            # Preloaded image, already sized (fixed h, width scaled by native aspect)
+            img = img_pool[t['path']]
+
+            # Stimulus onset (marker on flip)
+            send_marker_on_flip(win, t['code'])
+            img.draw()
+            # Zero the keyboard clock on the onset flip so key.rt is the RT from stim onset
+            win.callOnFlip(kb.clearEvents)
+            win.callOnFlip(kb.clock.reset)
             win.flip()
-            keys = kb.getKeys(keyList=[KEY_INTACT, KEY_SCRAMBLED, 'escape'], waitRelease=False)
-            if keys and resp_key is None:
-                k = keys[0].name
-                if k == 'escape':
+            stim_on = core.getTime()
+
+            # Show for STIM_TIME; collect responses but don't shorten timing
+            while (core.getTime() - stim_on) < STIM_TIME:
+                keys = kb.getKeys(keyList=[KEY_INTACT, KEY_SCRAMBLED, 'escape'], waitRelease=False)
+                if keys and resp_key is None:
+                    k = keys[0].name
+                    if k == 'escape':
+                        win.close(); core.quit()
+                    if k in (KEY_INTACT, KEY_SCRAMBLED):
+                        resp_key = k
+                        rt_ms = keys[0].rt * 1000.0
+                core.wait(0.001, hogCPUperiod=0)
+
+            # Blank ISI (randomized)
+            isi = isis[t_idx - 1]
+            isi_start = core.getTime()
+            win.flip()  # single flip to blank; nothing changes until the next stimulus
+            while (core.getTime() - isi_start) < isi:
+                core.wait(0.002, hogCPUperiod=0)
+                keys = kb.getKeys(keyList=[KEY_INTACT, KEY_SCRAMBLED, 'escape'], waitRelease=False)
+                if keys and resp_key is None:
+                    k = keys[0].name
+                    if k == 'escape':
+                        win.close(); core.quit()
+                    if k in (KEY_INTACT, KEY_SCRAMBLED):
+                        resp_key = k
+                        rt_ms = keys[0].rt * 1000.0
+
+            # Score and push accuracy marker
+            if resp_key is not None:
+                expect = KEY_SCRAMBLED if t['scrambled'] else KEY_INTACT
+                correct = int(resp_key == expect)
+                outlet.push_sample([RESP_CORRECT if correct else RESP_INCORRECT])
+
+            # Log
+            fh.write(ROW_FMT.format(
+                ts=stim_on - session_t0,
+                idx=t_idx,
+                img=os.path.basename(t['path']),
+                cls=t['cls'],
+                scr=int(t['scrambled']),
+                code=t['code'],
+                rk=resp_key if resp_key else '',
+                cor=correct,
+                rt=f"{rt_ms:.2f}" if rt_ms else '',
+                stt=STIM_TIME,
+                isi=isi,
+                w=t['size'][0],  # width shown (units='height')
+                h=t['size'][1]   # height shown (should be STIM_HEIGHT)
+            ))
+
+            for k in kb.getKeys(waitRelease=False):
+                if k.name == 'escape':
                     win.close(); core.quit()
-                if k in (KEY_INTACT, KEY_SCRAMBLED):
-                    resp_key = k
-                    rt_ms = (core.getTime() - stim_on) * 1000.0
-
-        # Score and push accuracy marker
-        if resp_key is not None:
-            expect = KEY_SCRAMBLED if t['scrambled'] else KEY_INTACT
-            correct = int(resp_key == expect)
-            outlet.push_sample([RESP_CORRECT if correct else RESP_INCORRECT])
-
-        # Log
-        with open(OUT_CSV, "a", newline="", encoding="utf-8") as fh:
-            w = csv.writer(fh)
-            w.writerow([
-                datetime.now().isoformat(timespec='milliseconds'),
-                t_idx,
-                os.path.basename(t['path']),
-                t['cls'],
-                int(t['scrambled']),
-                t['code'],
-                resp_key if resp_key else '',
-                correct,
-                round(rt_ms, 2) if rt_ms else '',
-                STIM_TIME,
-                round(isi, 3),
-                round(t['size'][0], 4),  # width shown (units='height')
-                round(t['size'][1], 4)   # height shown (should be STIM_HEIGHT)
-            ])
-
-        for k in kb.getKeys(waitRelease=False):
-            if k.name == 'escape':
-                win.close(); core.quit()
 
     # End
     end = write_text(
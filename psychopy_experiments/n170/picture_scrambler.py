@@ -7,10 +7,20 @@ Canonical N170 scrambler (color preserved correctly)
   (stronger than mean/std: matches the whole color distribution)
 """
 
-import os, glob
+import os, glob, zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
+from scipy.fft import rfft2, irfft2
 from PIL import Image, UnidentifiedImageError
 
+# libjpeg-turbo (SIMD IDCT/FDCT) when PyTurboJPEG is installed; PIL otherwise
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
 # ---------- CONFIG ----------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 IN_DIR   = os.path.join(BASE_DIR, "media")
@@ -20,113 +30,184 @@ RANDOM_SEED = 1234   # lock set for reproducibility (set None to vary)
 # ----------------------------
 
 # ---------- HELPERS ----------
-def is_image_ok(path):
-    try:
-        with Image.open(path) as im:
-            im.verify()
-        return True
-    except Exception:
-        return False
+def is_jpeg(path):
+    return os.path.splitext(path)[1].lower() in (".jpg", ".jpeg")
 
 def load_rgb01(path):
-    im = Image.open(path).convert("RGB")
-    arr = np.asarray(im, dtype=np.float32) / 255.0  # H x W x 3
+    if _tj is not None and is_jpeg(path):
+        with open(path, "rb") as fh:
+            u8 = _tj.decode(fh.read(), pixel_format=TJPF_RGB)
+    else:
+        with Image.open(path) as im:
+            im.draft("RGB", im.size)  # let the JPEG decoder emit RGB directly
+            u8 = np.asarray(im.convert("RGB"))
+    arr = u8.astype(np.float32) / 255.0  # H x W x 3
     return arr
 
 def save_rgb01(path, arr):
     arr = np.clip(arr, 0.0, 1.0)
-    Image.fromarray((arr * 255.0).astype(np.uint8), mode="RGB").save(path, quality=95)
-
-def wrap_phase(ph):
-    return (ph + np.pi) % (2*np.pi) - np.pi
+    u8 = (arr * 255.0).astype(np.uint8)
+    if _tj is not None and is_jpeg(path):
+        # same quality / 4:2:0 subsampling as PIL's JPEG writer
+        with open(path, "wb") as fh:
+            fh.write(_tj.encode(np.ascontiguousarray(u8), quality=95,
+                                pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420))
+    else:
+        Image.fromarray(u8, mode="RGB").save(path, quality=95)
+
+def wrap_phase(ph, out=None):
+    two_pi = np.asarray(2*np.pi, dtype=ph.dtype)
+    half = np.asarray(np.pi, dtype=ph.dtype)
+    out = np.add(ph, half, out=out)
+    np.mod(out, two_pi, out=out)
+    out -= half
+    return out
 
-def hist_match_channel(src, tmpl):
+def hist_match_channel(src, tmpl, out=None):
     """
     Histogram match 2D array src to 2D array tmpl (both float in [0,1]).
-    Returns src' whose histogram follows tmpl.
+    Returns src' whose histogram follows tmpl (written into `out` if given,
+    which must be a contiguous float32 array of src's shape).
+    Rank-based: the k-th smallest src pixel takes the value at the same
+    relative rank in sorted tmpl (src is continuous, so ties are negligible).
     """
     s = src.ravel()
-    t = tmpl.ravel()
-    s_values, s_idx, s_counts = np.unique(s, return_inverse=True, return_counts=True)
-    t_values, t_counts = np.unique(t, return_counts=True)
-    s_quantiles = np.cumsum(s_counts).astype(np.float64) / s.size
-    t_quantiles = np.cumsum(t_counts).astype(np.float64) / t.size
-    # interpolate target values at source quantiles
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
-    matched = interp_t_values[s_idx].reshape(src.shape)
-    return matched.astype(np.float32)
-
-def phase_scramble_color_shared(img01, alpha=0.0, rng=None):
+    t_sorted = np.sort(tmpl.ravel())
+    order = np.argsort(s)
+    if t_sorted.size != s.size:
+        # resample template ranks onto source ranks
+        t_sorted = t_sorted[(np.arange(s.size) * (t_sorted.size - 1)) // max(s.size - 1, 1)]
+    # scatter: the pixel at order[i] gets the i-th template value
+    if out is None:
+        out = np.empty(src.shape, dtype=np.float32)
+    out.reshape(-1)[order] = t_sorted
+    return out
+
+class ScrambleWorkspace:
+    """Preallocated buffers for phase_scramble_color_shared, for one image shape."""
+
+    def __init__(self, H, W):
+        Wr = W // 2 + 1  # real-FFT half spectrum width
+        self.shape = (H, W)
+        self.chw = np.empty((3, H, W), dtype=np.float32)
+        self.phi_rand = np.empty((H, Wr), dtype=np.float32)
+        self.amp = np.empty((3, H, Wr), dtype=np.float32)
+        self.phi = np.empty((3, H, Wr), dtype=np.float32)
+        self.trig = np.empty((3, H, Wr), dtype=np.float32)
+        self.spec = np.empty((3, H, Wr), dtype=np.complex64)
+        self.out_chw = np.empty((3, H, W), dtype=np.float32)
+
+# One workspace per image shape, per process (the ERP CORE set is uniform in size)
+_WORKSPACES = {}
+
+def get_workspace(H, W):
+    ws = _WORKSPACES.get((H, W))
+    if ws is None:
+        ws = _WORKSPACES[(H, W)] = ScrambleWorkspace(H, W)
+    return ws
+
+def phase_scramble_color_shared(img01, alpha=0.0, rng=None, workers=-1, ws=None):
     """
     Phase-scramble with a SINGLE random phase field shared across R,G,B.
     Per-channel amplitude preserved; phase fully randomized when alpha=0.
+    Each channel is then histogram-matched to its original and clipped,
+    so the result (H x W x 3) is ready to save.
+    `workers` is passed to scipy.fft (-1 = all cores).
+    Intermediates live in `ws` (a ScrambleWorkspace for this shape; a fresh one
+    if None). The result is a view into ws, valid until its next use.
     """
     if rng is None:
         rng = np.random.default_rng()
     H, W, C = img01.shape
     assert C == 3
-
-    # Build one random phase field (H x W)
-    phi_rand = rng.uniform(-np.pi, np.pi, size=(H, W)).astype(np.float32)
-
-    out = np.empty_like(img01)
+    if ws is None:
+        ws = ScrambleWorkspace(H, W)
+    assert ws.shape == (H, W)
+
+    # Build one random phase field over the real-FFT half spectrum (H x W//2+1)
+    # (drawn as float32 directly; the whole pipeline stays float32/complex64)
+    phi_rand = rng.random(out=ws.phi_rand, dtype=np.float32)
+    phi_rand *= np.float32(2 * np.pi)
+    phi_rand -= np.float32(np.pi)
+    # Columns that rfft2 stores in full (DC, and Nyquist for even W) must stay
+    # Hermitian along H so the inverse is truly real: phi[-k] = -phi[k]
+    k = np.arange(1, (H + 1) // 2)
+    for col in ((0, W // 2) if W % 2 == 0 else (0,)):
+        phi_rand[H - k, col] = -phi_rand[k, col]
+        phi_rand[0, col] = 0.0
+        if H % 2 == 0:
+            phi_rand[H // 2, col] = 0.0
+
+    # Work channel-planar (3 x H x W) so every per-channel slice is contiguous
+    chw = ws.chw
+    np.copyto(chw, img01.transpose(2, 0, 1))
+    F = rfft2(chw, axes=(-2, -1), workers=workers)
+    A = np.abs(F, out=ws.amp)  # float32: scipy.fft keeps float32 -> complex64
+    phi = np.arctan2(F.imag, F.real, out=ws.phi)
+    del F
+
+    # Mix with shared phi_rand (alpha=0 -> pure random)
+    phi *= np.float32(alpha)
+    phi += np.float32(1.0 - alpha) * phi_rand[None, :, :]
+    wrap_phase(phi, out=phi)
+
+    # A*exp(i*phi) written straight into a complex64 buffer (no complex128 temporaries)
+    spec, trig = ws.spec, ws.trig
+    np.cos(phi, out=trig)
+    np.multiply(A, trig, out=spec.real)
+    np.sin(phi, out=trig)
+    np.multiply(A, trig, out=spec.imag)
+
+    rec = irfft2(spec, s=(H, W), axes=(-2, -1), workers=workers)
+
+    # No min-max: histogram-match each channel back to the original instead
+    out = ws.out_chw
     for c in range(3):
-        x = img01[..., c]
-        F = np.fft.fft2(x)
-        A = np.abs(F).astype(np.float32)
-        phi_orig = np.angle(F).astype(np.float32)
-
-        # Mix with shared phi_rand (alpha=0 -> pure random)
-        phi_mix = wrap_phase(alpha * phi_orig + (1.0 - alpha) * phi_rand)
-
-        rec = np.fft.ifft2(A * np.exp(1j * phi_mix))
-        out[..., c] = np.real(rec).astype(np.float32)
-
-    # DO NOT min-max; we’ll histogram-match next
-    return out
+        hist_match_channel(rec[c], chw[c], out=out[c])
+    np.clip(out, 0.0, 1.0, out=out)
+    return out.transpose(1, 2, 0)
 # ----------------------------
 
-def batch(paths, label, rng):
-    for p in paths:
-        base = os.path.basename(p)
-        stem, _ = os.path.splitext(base)
-        try:
-            x = load_rgb01(p)  # original in [0,1]
-        except UnidentifiedImageError:
-            print(f"[SKIP] {base} (unreadable)")
-            continue
-        except Exception as e:
-            print(f"[SKIP] {base} ({e})")
-            continue
-
-        # 1) Shared-phase scramble (alpha=0.0 for canonical)
-        x_scr = phase_scramble_color_shared(x, alpha=ALPHA, rng=rng)
-
-        # 2) Per-channel histogram matching back to original channel
-        x_s = np.empty_like(x_scr)
-        for c in range(3):
-            x_s[..., c] = hist_match_channel(x_scr[..., c], x[..., c])
-
-        # 3) Clip and save
-        x_s = np.clip(x_s, 0.0, 1.0)
-        idx = stem.split('_')[-1]
-        out_name = (f"scrambled_face_{idx}.jpg" if label == "face"
-                    else f"scrambled_car_{idx}.jpg")
-        save_rgb01(os.path.join(OUT_DIR, out_name), x_s)
-        print(f"[OK] {base} -> {out_name} (alpha={ALPHA}, shared-phase + hist-match)")
+def image_seed(path):
+    """Per-image seed derived from RANDOM_SEED and the file name, so results
+    don't depend on which worker or in what order an image is processed."""
+    if RANDOM_SEED is None:
+        return None
+    return [RANDOM_SEED, zlib.crc32(os.path.basename(path).encode("utf-8"))]
+
+def process_one(path, label, seed):
+    """Load -> scramble -> hist-match -> save one image; returns a log line."""
+    base = os.path.basename(path)
+    stem, _ = os.path.splitext(base)
+    try:
+        x = load_rgb01(path)  # original in [0,1]
+    except UnidentifiedImageError:
+        return f"[SKIP] {base} (unreadable)"
+    except Exception as e:
+        return f"[SKIP] {base} ({e})"
+
+    # Shared-phase scramble + per-channel histogram matching to the original.
+    # One FFT thread per process: the pool already spreads images over the cores.
+    rng = np.random.default_rng(seed)
+    ws = get_workspace(x.shape[0], x.shape[1])
+    x_s = phase_scramble_color_shared(x, alpha=ALPHA, rng=rng, workers=1, ws=ws)
+
+    idx = stem.split('_')[-1]
+    out_name = (f"scrambled_face_{idx}.jpg" if label == "face"
+                else f"scrambled_car_{idx}.jpg")
+    save_rgb01(os.path.join(OUT_DIR, out_name), x_s)
+    return f"[OK] {base} -> {out_name} (alpha={ALPHA}, shared-phase + hist-match)"
+
+def batch(paths, label, executor):
+    seeds = [image_seed(p) for p in paths]
+    for msg in executor.map(process_one, paths, repeat(label), seeds):
+        print(msg)
 
 # ---------- RUN ----------
 if __name__ == "__main__":
-    all_faces = sorted(glob.glob(os.path.join(IN_DIR, "face_*.jpg")))
-    all_cars  = sorted(glob.glob(os.path.join(IN_DIR,  "car_*.jpg")))
-    faces = [p for p in all_faces if is_image_ok(p)]
-    cars  = [p for p in all_cars  if is_image_ok(p)]
-
-#    skipped = (set(all_faces) - set(faces)) | (set(all_cars) - set(cars))
-#    if skipped:
-#        print("Skipped unreadable files:")
-#        for b in sorted(skipped):
-#            print("  -", os.path.basename(b))
+    # No verify() pre-pass: unreadable files fail in load_rgb01 and are reported as [SKIP]
+    faces = sorted(glob.glob(os.path.join(IN_DIR, "face_*.jpg")))
+    cars  = sorted(glob.glob(os.path.join(IN_DIR,  "car_*.jpg")))
 
     if not faces and not cars:
         raise SystemExit(f"No valid inputs in {IN_DIR}")
@@ -134,8 +215,8 @@ if __name__ == "__main__":
     print(f"Input: faces={len(faces)} cars={len(cars)}")
     print(f"Mode : alpha={ALPHA} (canonical), shared-phase across RGB + per-channel histogram matching")
 
-    rng = np.random.default_rng(RANDOM_SEED) if RANDOM_SEED is not None else np.random.default_rng()
-    batch(faces, "face", rng)
-    batch(cars,  "car",  rng)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        batch(faces, "face", executor)
+        batch(cars,  "car",  executor)
 
     print("\nDone.")
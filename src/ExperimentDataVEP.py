@@ -6,6 +6,8 @@ from .UnicornData import UnicornData
 
 
 class ExperimentDataVEP(UnicornData):
+    __slots__ = ('tmin', 'tmax', '_raw', '_epochs', 'trials')
+
     def __init__(self, xdf_path, min_frequency=0.5, max_frequency=30, tmin=-0.2, tmax=0.5, bad_ch=None, delay=0):
         super().__init__(xdf_path, delay)
         self.tmin = tmin
@@ -19,11 +21,8 @@ class ExperimentDataVEP(UnicornData):
             self._filter_markers()
 
     def _filter_markers(self):
-        events = []
-        for i, marker in enumerate(self.marker_data):
-            eeg_start_index = np.argmax(self.eeg_time >= self.marker_time[i]) - 1
-            events.append([eeg_start_index, 0, marker])
-        events = np.array(events)
+        eeg_start_index = np.searchsorted(self.eeg_time, self.marker_time, side='left') - 1
+        events = np.column_stack([eeg_start_index, np.zeros_like(eeg_start_index), np.asarray(self.marker_data)])
         event_dict = dict(standard=1, oddball=2)
         self._epochs = mne.Epochs(self._raw, events, event_id=event_dict, tmin=self.tmin, tmax=self.tmax, preload=True,
                                   baseline=(None, 0 if self.tmin < 0 else None))
@@ -34,7 +33,9 @@ class ExperimentDataVEP(UnicornData):
         mne.set_log_level('WARNING')
         info = mne.create_info(ch_names=['Fz', 'C3', 'Cz', 'C4', 'Pz', 'PO7', 'Oz', 'PO8'], ch_types=['eeg'] * 8,
                                sfreq=250)
-        raw = mne.io.RawArray([1e-6 * self.eeg_data[:, i] for i in range(8)], info)
+        data = np.ascontiguousarray(self.eeg_data.T, dtype=np.float64)  # (n_channels, n_times)
+        data *= 1e-6  # in volts
+        raw = mne.io.RawArray(data, info, copy='info')  # data is ours, MNE can keep it as is
         raw.notch_filter(freqs=[50])
         raw.filter(min_frequency, max_frequency)
         self._raw = raw
@@ -1,26 +1,105 @@
+import functools
+import hashlib
 import os
+import tempfile
 
 import mne
 import numpy as np
 import pyxdf
+from scipy.signal import oaconvolve
+
+
+@functools.lru_cache(maxsize=8)
+def _load_xdf_cached(path, mtime):
+    return pyxdf.load_xdf(path)[0]
+
+
+def _load_xdf(xdf_path):
+    # Parsed streams are shared between instances loading the same file; treat them as read-only.
+    # The mtime is part of the key so a rewritten file is parsed again.
+    path = os.path.abspath(xdf_path)
+    return _load_xdf_cached(path, os.path.getmtime(path))
+
+
+def _filter_cache_path(cache_dir, xdf_path, params):
+    # One FIF file per recording and filter settings; a rewritten XDF file or another
+    # MNE version (different filter design) gets a new entry
+    path = os.path.abspath(xdf_path)
+    key = repr((path, os.path.getmtime(path), mne.__version__, 'composite-fir', params))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '_raw.fif')
+
+
+def _save_raw_atomic(raw, path):
+    # Write under a temporary name and rename, so concurrent readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(suffix='_raw.fif', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        raw.save(tmp_path, fmt='double', overwrite=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+EEG_CH_NAMES = ['Fz', 'C3', 'Cz', 'C4', 'Pz', 'PO7', 'Oz', 'PO8']
+
+
+def _composite_fir(sfreq, l_freq, h_freq, notch_freqs):
+    # Same designs raw.filter / raw.notch_filter use by default (firwin, zero phase, 'auto' lengths),
+    # convolved into one kernel so the data is only filtered once
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, fir_design='firwin', verbose=False)
+    for freq in notch_freqs:
+        # notch_filter defaults: notch width freq / 200, 1 Hz transition band
+        half_width = freq / 400 + 0.5
+        h_notch = mne.filter.create_filter(None, sfreq, freq + half_width, freq - half_width,
+                                           l_trans_bandwidth=0.5, h_trans_bandwidth=0.5,
+                                           fir_design='firwin', verbose=False)
+        h = np.convolve(h, h_notch)
+    return h
+
+
+def _apply_fir(data, h):
+    # h is symmetric with odd length, so the 'valid' part of the reflect-padded signal is zero phase
+    n = len(h) // 2
+    padded = np.pad(data, ((0, 0), (n, n)), mode='reflect')
+    return oaconvolve(padded, h[np.newaxis, :], mode='valid', axes=1)
 
 
 class UnicornData:
+    __slots__ = ('_remove_last_event', '_xdf_path', '_xdf_data', '_delay', '_eeg_stream', '_marker_stream',
+                 'eeg_time', '_time_offset', 'eeg_data', 'marker_time', 'marker_data', 'metadata', 'raw', 'events',
+                 'epochs')
+    # The parsed XDF file and the streams inside it; only needed while __init__ reads them
+    _XDF_ATTRS = ('_xdf_data', '_eeg_stream', '_marker_stream')
+
+    def __getstate__(self):
+        # Pickled copies (e.g. UnicornDataSensor.batch results sent back from workers) leave out the XDF streams
+        return {name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())
+                if name not in self._XDF_ATTRS and hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name in self._XDF_ATTRS:
+            setattr(self, name, None)
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def _read_metadata(self, original_filename):
         # Read info of the first stream
         info = self._eeg_stream['info']
         self.metadata = {
             "effective_sample_rate": info['effective_srate'],
-            "markers": list(set(self.marker_data)),
+            "markers": np.unique(self.marker_data).tolist(),
             "original_filename": original_filename
         }
 
     def _read_eeg_data(self):
         # Read data of the first stream
-        self.eeg_time = self._eeg_stream['time_stamps']
-        self._time_offset = min(self.eeg_time)
-        self.eeg_time = self.eeg_time - self._time_offset - self._delay
-        self.eeg_data = self._eeg_stream['time_series'][:, :8]
+        # np.array copies: the stream is shared through the XDF cache, so never shift it in place
+        self.eeg_time = np.array(self._eeg_stream['time_stamps'], dtype=np.float64)
+        self._time_offset = self.eeg_time[0]  # time stamps are sorted
+        self.eeg_time -= self._time_offset + self._delay
+        # Own contiguous copy of the 8 EEG columns; float32 is ample for the 24-bit ADC
+        self.eeg_data = np.ascontiguousarray(self._eeg_stream['time_series'][:, :8], dtype=np.float32)
         # self.accelerometer_data = self._xdf_data[0]['time_series'][:, 8:11]
         # self.gyroscope_data = self._xdf_data[0]['time_series'][:, 11:14]
         # self.battery_level_data = self._xdf_data[0]['time_series'][:, 14]
@@ -29,20 +108,51 @@ class UnicornData:
 
     def _read_marker_data(self):
         # Read data of the second stream
-        self.marker_time = self._marker_stream['time_stamps']
-        self.marker_time = self.marker_time - self._time_offset
-        self.marker_data = [x[0] for x in self._marker_stream['time_series']]
+        self.marker_time = np.array(self._marker_stream['time_stamps'], dtype=np.float64)
+        self.marker_time -= self._time_offset
+        # Single-channel stream: column 0 as one array (numeric streams come as 2D arrays,
+        # string streams as lists of 1-element lists)
+        self.marker_data = np.asarray(self._marker_stream['time_series'])[:, 0]
+        if self._marker_stream['info']['channel_format'][0] != 'string':
+            # Numeric codes (possibly sent as floats): integers, so '== code' tests are exact masks
+            self.marker_data = self.marker_data.astype(np.int32)
+
+    def _raw_volts(self):
+        data = np.ascontiguousarray(self.eeg_data.T, dtype=np.float64)  # (n_channels, n_times)
+        data *= 1e-6  # in volts
+        return data
 
     def _create_raw_data(self):
         # Create raw data
-        info = mne.create_info(ch_names=['Fz', 'C3', 'Cz', 'C4', 'Pz', 'PO7', 'Oz', 'PO8'], ch_types=['eeg'] * 8,
-                               sfreq=250)
-        raw = mne.io.RawArray([1e-6 * self.eeg_data[:, i] for i in range(8)], info)
+        info = mne.create_info(ch_names=EEG_CH_NAMES, ch_types=['eeg'] * 8, sfreq=250)
+        raw = mne.io.RawArray(self._raw_volts(), info, copy='info')  # data is ours, MNE can keep it as is
         self.raw = raw
 
-    def filter(self, l_freq=0.5, h_freq=30, notch_freqs=[50]):
-        self.raw.notch_filter(freqs=notch_freqs)
-        self.raw.filter(l_freq, h_freq)
+    def _raw_is_unchanged(self):
+        # True while self.raw still holds what _create_raw_data built (plus the standard montage)
+        raw = self.raw
+        return (raw.preload and raw.ch_names == EEG_CH_NAMES and not raw.info['bads'] and raw.first_samp == 0
+                and len(raw.annotations) == 0 and np.array_equal(raw.get_data(), self._raw_volts()))
+
+    def filter(self, l_freq=0.5, h_freq=30, notch_freqs=[50], cache_dir=None):
+        # With cache_dir, the filtered data of an untouched raw is stored as FIF and reused by later instances
+        cache_path = None
+        if cache_dir is not None and self._raw_is_unchanged():
+            cache_path = _filter_cache_path(cache_dir, self._xdf_path, (l_freq, h_freq, tuple(notch_freqs)))
+        if cache_path is not None and os.path.exists(cache_path):
+            self.raw = mne.io.read_raw_fif(cache_path, preload=False)
+        else:
+            self.raw.load_data()  # no-op unless self.raw came from the cache
+            h = _composite_fir(self.raw.info['sfreq'], l_freq, h_freq, notch_freqs)
+            self.raw.apply_function(_apply_fir, picks='data', channel_wise=False, h=h)
+            with self.raw.info._unlock():  # record the pass band like raw.filter() does
+                if l_freq is not None:
+                    self.raw.info['highpass'] = l_freq
+                if h_freq is not None:
+                    self.raw.info['lowpass'] = h_freq
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                _save_raw_atomic(self.raw, cache_path)
         return self
 
     def _create_montage(self):
@@ -50,35 +160,46 @@ class UnicornData:
         self.raw.set_montage(montage)
 
     def _parse_events(self):
-        events = []
-        for i, marker in enumerate(self.marker_data):
-            eeg_start_index = np.argmax(self.eeg_time >= self.marker_time[i]) - 1
-            events.append([eeg_start_index, 0, marker])
-        events = np.array(events)
+        # Index of the last EEG sample before each marker (eeg_time is sorted)
+        eeg_start_index = np.searchsorted(self.eeg_time, self.marker_time, side='left') - 1
+        if self.marker_data.dtype.kind == 'i':
+            # MNE's (n_events, 3) int64 layout, filled in place
+            events = np.zeros((len(eeg_start_index), 3), dtype=np.int64)
+            events[:, 0] = eeg_start_index
+            events[:, 2] = self.marker_data
+        else:
+            # String markers cannot form MNE events; keep them alongside the sample indices
+            events = np.column_stack([eeg_start_index, np.zeros_like(eeg_start_index), self.marker_data])
         # NOTE: We remove the last event because it is an artifact (end of recording)
         if self._remove_last_event:
             events = events[:-1, :]
         self.events = events
 
-    def create_epochs(self, picks=None, event_dict=None, tmin=-0.2, tmax=1, reject_criteria=None):
-        epochs = mne.Epochs(self.raw.copy(), self.events, event_id=event_dict, tmin=tmin, tmax=tmax, preload=True,
+    def create_epochs(self, picks=None, event_dict=None, tmin=-0.2, tmax=1, reject_criteria=None, preload=True):
+        # Streamed epochs keep reading from the Raw they are given, so they get their own copy;
+        # a later filter() on self.raw must not change them
+        raw = self.raw if preload else self.raw.copy()
+        epochs = mne.Epochs(raw, self.events, event_id=event_dict, tmin=tmin, tmax=tmax, preload=preload,
                             baseline=(None, 0 if tmin < 0 else None), picks=picks, reject=reject_criteria)
         self.epochs = epochs
         return epochs
 
     def __init__(self, xdf_path, delay=0, remove_last_event=True):
         self._remove_last_event = remove_last_event
-        self._xdf_data = pyxdf.load_xdf(xdf_path)[0]
+        self._xdf_path = xdf_path
+        self._xdf_data = _load_xdf(xdf_path)
         self._delay = delay
         # Ensure we read correct streams
+        self._eeg_stream = self._marker_stream = None
         for stream in self._xdf_data:
             stream_type = stream['info']['type'][0]
             stream_size = int(stream['footer']['info']['sample_count'][0])
-            print(stream_type, stream_size)
             if stream_type == 'Data' and stream_size > 0:
                 self._eeg_stream = stream
             if stream_type == 'Markers' and stream_size > 0:
                 self._marker_stream = stream
+            if self._eeg_stream is not None and self._marker_stream is not None:
+                break
         assert self._eeg_stream is not None, "No EEG stream found in the XDF file."
         assert self._marker_stream is not None, "No marker stream found in the XDF file."
         self._read_eeg_data()
@@ -1,13 +1,26 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 from . import UnicornData
 import numpy as np
 import mne
 
 
 class UnicornDataSensor(UnicornData):
-    def __init__(self, xdf_path, channels=['Fz']):
+    __slots__ = ()
+
+    def __init__(self, xdf_path, channels=['Fz'], cache_dir=None):
         super().__init__(xdf_path, delay=0, remove_last_event=False)
-        self.filter(l_freq=0.1, h_freq=30, notch_freqs=[50])
-        self.create_epochs(picks=channels, event_dict=dict(standard=1), tmin=-0.2, tmax=1)
+        self.filter(l_freq=0.1, h_freq=30, notch_freqs=[50], cache_dir=cache_dir)
+        # Epochs are only streamed through iter_evoked() in plot(), so they are read on demand
+        self.create_epochs(picks=channels, event_dict=dict(standard=1), tmin=-0.2, tmax=1, preload=False)
+
+    @classmethod
+    def batch(cls, xdf_paths, channels=['Fz'], n_workers=None, cache_dir=None):
+        # Load and filter several recordings in parallel; results come back in the order of xdf_paths.
+        # Processes rather than threads, since XDF parsing holds the GIL.
+        with ProcessPoolExecutor(max_workers=n_workers) as ex:
+            return list(ex.map(partial(cls, channels=channels, cache_dir=cache_dir), xdf_paths))
 
     def plot(self, confidence_interval=0.5, picks='eeg'):
         evokeds = dict(
@@ -17,19 +30,21 @@ class UnicornDataSensor(UnicornData):
 
     def get_fixed_delay(self) -> (int, int):
         # Calculate the time delay for first peak
-        delays = []
-        for i, marker in enumerate(self.marker_data):
-            if marker == 1:
-                eeg_start_index = np.argmax(self.eeg_time >= self.marker_time[i]) - 1
-                eeg_end_index = int(eeg_start_index + self.raw.info['sfreq'])  # 1 second after the marker
-                # Find the index of the maximum value in the epoch data for channel 'Fz' (index 0)
-                epoch_data = self.eeg_data[eeg_start_index:eeg_end_index, 0]
-                peak_value = np.max(epoch_data)
-                threshold = 0.5 * peak_value
-                peak_index = np.argmax(epoch_data >= threshold)
-                # Convert index to time in milliseconds
-                peak_time = (peak_index / self.raw.info['sfreq']) * 1000
-                delays.append(peak_time)
-        print(delays)
+        sfreq = self.raw.info['sfreq']
+        starts = np.searchsorted(self.eeg_time, self.marker_time[self.marker_data == 1]) - 1
+        delays = _peak_delays(self.eeg_data[:, 0], starts, int(sfreq)) / sfreq * 1000  # in milliseconds
+        print(delays.tolist())
         # Return mean and standard deviation of delays
         return int(np.mean(delays)), int(np.std(delays))
+
+
+def _peak_delays(signal, starts, n_samples):
+    """
+    For each window signal[start:start + n_samples], return the offset (in samples) of the
+    first sample reaching half of the window's maximum. Windows running past the end are cut short.
+    """
+    # Clipping repeats the last sample past the end, which changes neither the maximum
+    # nor the first crossing, so no separate validity mask is needed
+    windows = signal.take(starts[:, None] + np.arange(n_samples), mode='clip')
+    peaks = windows.max(axis=1)
+    return np.argmax(windows >= 0.5 * peaks[:, None], axis=1)